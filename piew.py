@@ -2,18 +2,892 @@
 # vim: fileencoding=utf-8
 
 import os
+import sys
+import stat
 import re
+import errno
+import shutil
+import urllib
+import math
+import time
+import bisect
+import array
+import hashlib
+import itertools
+import sqlite3
+import mmap
+import struct
+import zlib
+import tarfile
+import zipfile
+import ctypes
+import ctypes.util
+import threading
+import subprocess
+import cPickle as pickle
+import Queue
+import multiprocessing
+import multiprocessing.pool
 import gi
 gi.require_version('Gtk', '3.0')
 from gi.repository import GLib, Gtk, Gdk, GdkPixbuf
+try:
+    import numpy
+except ImportError:
+    numpy = None  # optional, needed for image statistics
+
+
+# Size of data chunks read from files and archives
+READ_CHUNK_SIZE = 1 << 20
+
+
+def iter_buffer_chunks(buf, offset, size, chunk_size=READ_CHUNK_SIZE):
+    """Iterate over chunks of a buffer region (e.g. a mmap object)."""
+    end = offset + size
+    while offset < end:
+        yield buf[offset:min(end, offset + chunk_size)]
+        offset += chunk_size
+
+
+# posix_fadvise() advice values
+POSIX_FADV_SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', 2)
+POSIX_FADV_WILLNEED = getattr(os, 'POSIX_FADV_WILLNEED', 3)
+
+def _get_posix_fadvise():
+    """Return a posix_fadvise() function, or None if not available."""
+    if hasattr(os, 'posix_fadvise'):
+        return os.posix_fadvise
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        f = libc.posix_fadvise
+    except (OSError, AttributeError):
+        return None
+    f.argtypes = [ctypes.c_int, ctypes.c_long, ctypes.c_long, ctypes.c_int]
+    return f
+
+_posix_fadvise = _get_posix_fadvise()
+
+def fadvise(fd, offset, length, advice):
+    """Announce an intention to access file data, if supported.
+
+    Hints are only hints: errors are silently ignored.
+    """
+    if _posix_fadvise is None:
+        return
+    try:
+        _posix_fadvise(fd, offset, length, advice)
+    except OSError:
+        pass
+
+def warm_file_cache(fname):
+    """Ask the kernel to start reading a file into the page cache.
+
+    Reading is asynchronous: this function returns immediately.
+    """
+    try:
+        fd = os.open(fname, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        fadvise(fd, 0, 0, POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+class MappedFile:
+    """Read-only memory mapping of a whole file.
+
+    The kernel is told that the file will be read sequentially (using
+    posix_fadvise() on the file), so that readahead is efficient for large
+    files. Chunks are copies of mapped data.
+
+    Instance attributes:
+      size -- file size
+      _mm -- mmap object, None for empty files
+    """
+
+    def __init__(self, fname):
+        with open(fname, 'rb') as f:
+            self.size = os.fstat(f.fileno()).st_size
+            if self.size == 0:
+                self._mm = None  # empty files cannot be mapped
+                return
+            fadvise(f.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def chunks(self, chunk_size=READ_CHUNK_SIZE):
+        """Iterate over chunks of file data."""
+        if self._mm is None:
+            return iter([])
+        return iter_buffer_chunks(self._mm, 0, self.size, chunk_size)
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+
+def load_pixbuf_animation(chunks, max_size=None, max_pixels=None, on_size=None, image_type=None):
+    """Decode a PixbufAnimation from an iterable of data chunks.
+
+    Data is streamed to a PixbufLoader, without being gathered first.
+    If image_type is set, it is the name of the loader to use. Otherwise the
+    format is guessed from data.
+    If max_size is set, image is scaled down, while decoding, to fit in a
+    (width,height) box. If max_pixels is set, image is scaled down to have at
+    most max_pixels pixels. Some loaders (e.g. JPEG) then decode less data.
+    If set, on_size is called with the original image size, before decoding.
+    Raise GLib.Error on invalid data.
+    """
+    if image_type is None:
+        loader = GdkPixbuf.PixbufLoader()
+    else:
+        loader = GdkPixbuf.PixbufLoader.new_with_type(image_type)
+    def size_prepared(loader, w, h):
+        if on_size is not None:
+            on_size(w, h)
+        k = 1.
+        if max_size is not None:
+            k = min(k, float(max_size[0])/w, float(max_size[1])/h)
+        if max_pixels is not None:
+            k = min(k, math.sqrt(float(max_pixels)/(w*h)))
+        if k < 1:
+            loader.set_size(max(1, int(w*k)), max(1, int(h*k)))
+    loader.connect('size-prepared', size_prepared)
+    try:
+        for chunk in chunks:
+            loader.write(chunk)
+        loader.close()
+    except Exception as e:
+        try:
+            loader.close()
+        except GLib.Error:
+            pass
+        raise e
+    finally:
+        # release resources held by unfinished generators
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    return loader.get_animation()
+
+
+class ArchiveBase:
+    """Random access to the members of an archive.
+
+    The archive index is read once, when the object is created, then the
+    archive file is closed: only the member table is kept, so that many
+    archives can be listed without exhausting file descriptors. Members are
+    read directly from the archive, without extracting it, the file being
+    opened again for each read.
+
+    The following instance methods must be defined:
+      names() -- return the list of (unicode) member names
+      size(name) -- return member size
+      read(name) -- return an iterable over chunks of member data
+
+    Members may be read from several threads.
+
+    Instance attributes:
+      path -- archive path
+    """
+
+    class LoadError(StandardError):
+        """Exception raised on archive reading error."""
+        pass
+
+    @staticmethod
+    def _decode_name(name, encoding):
+        """Return a member name as a safe relative unicode path.
+
+        Leading '/', '.' and '..' components are removed, so that members
+        never name files outside of the archive. Return None for empty names.
+        """
+        if not isinstance(name, unicode):
+            name = name.decode(encoding, 'replace')
+        parts = [p for p in name.replace(u'\\', u'/').split(u'/') if p not in (u'', u'.', u'..')]
+        return u'/'.join(parts) or None
+
+    def _read_range(self, offset, size):
+        """Iterate over chunks of a region of the archive file."""
+        with open(self.path, 'rb') as f:
+            fadvise(f.fileno(), offset, size, POSIX_FADV_SEQUENTIAL)
+            f.seek(offset)
+            while size > 0:
+                chunk = f.read(min(size, READ_CHUNK_SIZE))
+                if not chunk:
+                    raise IOError("unexpected end of archive")
+                size -= len(chunk)
+                yield chunk
+
+class ArchiveZip(ArchiveBase):
+    """Zip archives (including comic book .cbz files).
+
+    Stored members are read as is, deflated members are decompressed on the
+    fly (other compression methods are not supported by zipfile either).
+
+    Instance attributes:
+      _infos -- ZipInfo of file members, indexed by name
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            zf = zipfile.ZipFile(path)
+            try:
+                infos = zf.infolist()
+            finally:
+                zf.close()
+        except (IOError, zipfile.BadZipfile) as e:
+            raise self.LoadError(str(e))
+        self._infos = {}
+        for i in infos:
+            name = self._decode_name(i.filename, 'cp437')
+            if name is not None and not i.filename.endswith('/'):
+                self._infos[name] = i
+
+    def names(self):
+        return self._infos.keys()
+
+    def size(self, name):
+        return self._infos[name].file_size
+
+    def read(self, name):
+        info = self._infos[name]
+        try:
+            if info.flag_bits & 0x1:
+                raise self.LoadError("encrypted members are not supported")
+            if info.compress_type == zipfile.ZIP_STORED:
+                decompressor = None
+            elif info.compress_type == zipfile.ZIP_DEFLATED:
+                decompressor = zlib.decompressobj(-15)
+            else:
+                raise self.LoadError("unsupported compression method: %d" % info.compress_type)
+            # data follows the local header, whose size is variable
+            header = ''.join(self._read_range(info.header_offset, 30))
+            if header[:4] != zipfile.stringFileHeader:
+                raise zipfile.BadZipfile("bad magic number for file header")
+            name_len, extra_len = struct.unpack('<HH', header[26:30])
+            offset = info.header_offset + 30 + name_len + extra_len
+            crc = 0
+            for chunk in self._read_range(offset, info.compress_size):
+                if decompressor is not None:
+                    chunk = decompressor.decompress(chunk)
+                crc = zlib.crc32(chunk, crc)
+                yield chunk
+            if decompressor is not None:
+                chunk = decompressor.flush()
+                crc = zlib.crc32(chunk, crc)
+                yield chunk
+            if crc & 0xffffffff != info.CRC:
+                raise zipfile.BadZipfile("bad CRC-32 for file %r" % name)
+        except (IOError, RuntimeError, struct.error, zlib.error, zipfile.BadZipfile) as e:
+            raise self.LoadError(str(e))
+
+class ArchiveTar(ArchiveBase):
+    """Tar archives (including comic book .cbt files).
+
+    Members of uncompressed archives are read directly. Compressed archives
+    are supported but random access to them is slow: the archive is
+    decompressed up to the member. Listing them requires to decompress the
+    whole archive, their index is thus stored in index_cache_dir.
+
+    Instance attributes:
+      _members -- (offset, size) of file members data, indexed by name
+      _compressed -- True if archive is compressed
+    """
+
+    # Directory of cached indexes of compressed archives, None to disable
+    index_cache_dir = '~/.cache/piew/tar-index'
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path, 'rb') as f:
+                magic = f.read(3)
+            self._compressed = magic[:2] == '\x1f\x8b' or magic == 'BZh'
+            members = self._compressed and self._load_index()
+            if not members:
+                members = []
+                # stream mode: a single pass, without seeking back
+                tf = tarfile.open(path, 'r|*')
+                try:
+                    for m in tf:
+                        if m.isfile():
+                            members.append((m.name, m.offset_data, m.size))
+                finally:
+                    tf.close()
+                if self._compressed:
+                    self._save_index(members)
+        except (IOError, EOFError, zlib.error, tarfile.TarError) as e:
+            raise self.LoadError(str(e))
+        self._members = {}
+        for name, offset, size in members:
+            name = self._decode_name(name, 'utf-8')
+            if name is not None:
+                self._members[name] = (offset, size)
+
+    def _index_path(self):
+        st = os.stat(self.path)
+        return os.path.join(os.path.expanduser(self.index_cache_dir),
+                            file_key(self.path, st.st_mtime, st.st_size))
+
+    def _load_index(self):
+        """Return the cached index of the archive, or None."""
+        if self.index_cache_dir is None:
+            return None
+        try:
+            with open(self._index_path(), 'rb') as f:
+                return pickle.load(f)
+        except (EnvironmentError, EOFError, pickle.UnpicklingError, ValueError):
+            return None
+
+    def _save_index(self, members):
+        """Store the index of the archive in the cache."""
+        if self.index_cache_dir is None:
+            return
+        path = self._index_path()
+        tmp = '%s.%d.tmp' % (path, threading.current_thread().ident)
+        try:
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass  # already exists, or error when writing
+            with open(tmp, 'wb') as f:
+                pickle.dump(members, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, path)
+        except EnvironmentError as e:
+            print "Cannot write archive index '%s': %s" % (path, e)
+
+    def names(self):
+        return self._members.keys()
+
+    def size(self, name):
+        return self._members[name][1]
+
+    def read(self, name):
+        offset, size = self._members[name]
+        try:
+            if not self._compressed:
+                for chunk in self._read_range(offset, size):
+                    yield chunk
+                return
+            tf = tarfile.open(self.path, 'r:*')
+            try:
+                info = tarfile.TarInfo(name)
+                info.offset_data, info.size = offset, size
+                f = tf.extractfile(info)
+                while True:
+                    chunk = f.read(READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                tf.close()
+        except (IOError, EOFError, zlib.error, tarfile.TarError) as e:
+            raise self.LoadError(str(e))
+
+
+# Archive classes to use for each extension (case insensitive)
+archive_types = {
+        '.zip': ArchiveZip,
+        '.cbz': ArchiveZip,
+        '.tar': ArchiveTar,
+        '.cbt': ArchiveTar,
+        '.tar.gz': ArchiveTar,
+        '.tgz': ArchiveTar,
+        '.tar.bz2': ArchiveTar,
+        }
+
+def get_archive_type(fname):
+    """Return the archive class to use for a file, or None."""
+    fname = fname.lower()
+    for ext, cls in archive_types.items():
+        if fname.endswith(ext):
+            return cls
+    return None
+
+
+def find_image_files(paths, exts):
+    """Return image files found in the given paths.
+
+    Directories are opened and images they contain are added.
+    Archives are handled like directories: their members are named after the
+    archive path.
+    Doublets are removed, files are sorted (string comparaison).
+    Return a (files, archive_members) pair, archive_members being a
+    {fname:(archive,name)} dict of archive members in files.
+    """
+
+    files = set() # not doublets
+    archive_members = {}
+    def add_file(f):
+        cls = get_archive_type(f)
+        if cls is None:
+            files.add(f)
+            return
+        try:
+            archive = cls(f)
+        except ArchiveBase.LoadError as e:
+            print "Invalid archive '%s': %s" % (f, e)
+            return
+        for name in archive.names():
+            ff = os.path.join(f, name)
+            archive_members[ff] = (archive, name)
+            files.add(ff)
+
+    for f in paths:
+        f = unicode(os.path.normpath(unicode(f)))
+        if os.path.isfile(f):
+            add_file(f)
+        if os.path.isdir(f):
+            for ff in sorted(os.listdir(f)):
+                if f != '.':
+                    ff = os.path.join(f, ff)
+                if os.path.isfile(ff):
+                    add_file(ff)
+    # convert to a list, filter, sort
+    is_image = lambda f: f.split('.')[-1].lower() in exts
+    files = sorted(f for f in files if is_image(f))
+    archive_members = dict((f, m) for f, m in archive_members.items() if is_image(f))
+    return files, archive_members
+
+
+def pixbuf_array(pb):
+    """Return pixel data of a pixbuf as a (height, width, channels) array.
+
+    Pixel data is retrieved with get_pixels() (which copies it), the returned
+    array is a view of it which honours rowstride.
+    Requires numpy.
+    """
+    data = pb.get_pixels()
+    n = pb.get_n_channels()
+    buf = numpy.frombuffer(data, numpy.uint8)
+    return numpy.lib.stride_tricks.as_strided(
+            buf, shape=(pb.get_height(), pb.get_width(), n),
+            strides=(pb.get_rowstride(), n, 1), writeable=False)
+
+
+def pixbuf_diff_rect(a, b):
+    """Return the bounding box of pixels which differ between two arrays.
+
+    Arrays are pixel data returned by pixbuf_array(), with the same shape.
+    Return a (x0, y0, x1, y1) tuple (x1 and y1 excluded), or None if pixels
+    are identical.
+    """
+    # compare rows of channel values, without reducing over channels first
+    h, w, n = a.shape
+    diff = a.reshape(h, w * n) != b.reshape(h, w * n)
+    rows = numpy.flatnonzero(diff.any(axis=1))
+    if not len(rows):
+        return None
+    cols = numpy.flatnonzero(diff[rows[0]:rows[-1]+1].any(axis=0)) // n
+    return (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+
+def union_rect(a, b):
+    """Return the bounding box of two (x0, y0, x1, y1) rectangles, or None."""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+def _dct_matrix(n):
+    """Return the (n,n) DCT-II matrix."""
+    k = numpy.arange(n)[:, None]
+    return numpy.cos(numpy.pi * (2 * numpy.arange(n)[None, :] + 1) * k / (2. * n))
+
+def _bits_to_int(bits):
+    """Convert an array of booleans to an integer, first item is the MSB."""
+    return int(numpy.packbits(bits.ravel()).tostring().encode('hex'), 16)
+
+def perceptual_hashes(pb):
+    """Return the (dHash, pHash) pair of a pixbuf, as 64-bit integers.
+
+    dHash compares adjacent pixels of a 9x8 grayscale thumbnail. pHash
+    compares low frequency DCT coefficients of a 32x32 grayscale thumbnail
+    to their median.
+    Requires numpy.
+    """
+    def gray(w, h):
+        a = pixbuf_array(pb.scale_simple(w, h, GdkPixbuf.InterpType.BILINEAR))
+        return a[:, :, :3].dot([0.299, 0.587, 0.114])
+    g = gray(9, 8)
+    dhash = _bits_to_int(g[:, 1:] > g[:, :-1])
+    c = _dct_matrix(32)
+    coefs = c.dot(gray(32, 32)).dot(c.T)[:8, :8].ravel()
+    phash = _bits_to_int(coefs > numpy.median(coefs[1:]))  # ignore DC
+    return dhash, phash
+
+
+class PixelStats:
+    """Statistics of pixel values, per channel.
+
+    Statistics are computed from channel histograms, which are built by
+    blocks of rows to bound memory usage.
+    Requires numpy.
+
+    Instance attributes:
+      region -- (x,y,width,height) of the processed image region
+      count -- number of pixels
+      hist -- histograms, as a (channels,256) array
+      min,max,mean,std -- value statistics, as arrays
+      clip_low,clip_high -- number of pixels with value 0 and 255, as arrays
+    """
+
+    # Number of pixels processed at once
+    block_pixels = 1 << 22
+
+    def __init__(self, pb, region=None):
+        if numpy is None:
+            raise RuntimeError("image statistics require numpy")
+        if region is None:
+            region = (0, 0, pb.get_width(), pb.get_height())
+        else:
+            pb = pb.new_subpixbuf(*region)
+        self.region = region
+        a = pixbuf_array(pb)
+        h, w, n = a.shape
+        self.count = w * h
+
+        # count all channels at once: channel c value v is counted at c*256+v
+        hist = numpy.zeros(n * 256, numpy.int64)
+        offsets = numpy.arange(n, dtype=numpy.uint16) * 256
+        rows = max(1, self.block_pixels // w)
+        for y in xrange(0, h, rows):
+            block = a[y:y+rows] + offsets
+            hist += numpy.bincount(block.ravel(), minlength=n*256)
+        self.hist = hist.reshape(n, 256)
+
+        values = numpy.arange(256, dtype=numpy.float64)
+        self.mean = self.hist.dot(values) / self.count
+        var = self.hist.dot(values ** 2) / self.count - self.mean ** 2
+        self.std = numpy.sqrt(numpy.maximum(var, 0))
+        nonzero = self.hist > 0
+        self.min = nonzero.argmax(axis=1)
+        self.max = 255 - nonzero[:, ::-1].argmax(axis=1)
+        self.clip_low = self.hist[:, 0]
+        self.clip_high = self.hist[:, 255]
+
+    def sparklines(self, nbins=32):
+        """Return histograms as lines of text, one per channel."""
+        bars = u' \u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588'
+        hist = self.hist.reshape(self.hist.shape[0], nbins, -1).sum(axis=2)
+        top = numpy.maximum(hist.max(axis=1), 1)[:, None]
+        levels = (hist * (len(bars) - 1) + top - 1) // top  # round up non-zero bins
+        return [u''.join(bars[v] for v in row) for row in levels]
+
+
+class FilenameIndex:
+    """Index of file names, for fast searches.
+
+    Searches are case insensitive. Prefix and fuzzy searches match file
+    basenames, substring searches match whole paths.
+    Prefix searches use a sorted list of basenames. Substring searches use a
+    trigram index: candidates are files whose path contains the rarest
+    trigram of the pattern. Fuzzy searches (pattern characters in order,
+    possibly separated) run a regex on all basenames joined in a single
+    string; when results are limited, the scan stops after fuzzy_scan_factor
+    times more matches than needed, and the best of them are returned.
+
+    The trigram index is long to build: it is built by steps, see
+    build_trigrams(). Until it is complete, substring searches run a regex
+    on all paths joined in a single string.
+
+    Files may be added to the index; they are not sorted with other files.
+
+    Instance attributes:
+      files -- indexed files
+      _indexed -- set of indexed files
+      _names -- sorted list of (basename, index) pairs
+      _paths -- lowercase paths
+      _trigrams -- trigram index: {trigram:array of indexes}
+      _ntrigrams -- number of paths added to the trigram index
+      _joined_paths,_joined_names -- lowercase paths and basenames, joined
+        with newlines
+      _path_starts,_name_starts -- position of each path and basename in
+        joined strings
+    """
+
+    # Limited fuzzy searches rank at most limit*fuzzy_scan_factor matches
+    # (most of the search time is spent on matches, not on the scan)
+    fuzzy_scan_factor = 20
+
+    def __init__(self, files):
+        self.files = list(files)
+        self._indexed = set(files)
+        self._paths = [f.lower() for f in files]
+        names = [os.path.basename(p) for p in self._paths]
+        self._names = sorted((name, i) for i, name in enumerate(names))
+        self._trigrams = {}
+        self._ntrigrams = 0
+        self._path_starts, self._name_starts = [], []
+        self._joined_paths = self._join(u'', self._path_starts, self._paths)
+        self._joined_names = self._join(u'', self._name_starts, names)
+
+    @staticmethod
+    def _join(joined, starts, strings):
+        """Append strings to joined strings, return the new joined string.
+
+        starts is updated in place.
+        """
+        if not strings:
+            return joined
+        if starts:
+            joined += u'\n'
+        pos = len(joined)
+        for s in strings:
+            starts.append(pos)
+            pos += len(s) + 1
+        return joined + u'\n'.join(strings)
+
+    def add(self, files):
+        """Add files to the index, if they are not indexed yet.
+
+        Added files are not sorted with other files, they come last in
+        substring search results. Call build_trigrams() to add them to the
+        trigram index.
+        """
+        n = len(self.files)
+        for f in files:
+            if f not in self._indexed:
+                self._indexed.add(f)
+                self.files.append(f)
+        paths = [f.lower() for f in self.files[n:]]
+        names = [os.path.basename(p) for p in paths]
+        for k, name in enumerate(names):
+            bisect.insort(self._names, (name, n + k))
+        self._paths.extend(paths)
+        self._joined_paths = self._join(self._joined_paths, self._path_starts, paths)
+        self._joined_names = self._join(self._joined_names, self._name_starts, names)
+
+    def build_trigrams(self, count):
+        """Add count paths to the trigram index.
+
+        Return True if the index is not complete yet.
+        """
+        trigrams = self._trigrams
+        end = min(len(self._paths), self._ntrigrams + count)
+        for i in xrange(self._ntrigrams, end):
+            p = self._paths[i]
+            for t in set([p[k:k+3] for k in xrange(len(p) - 2)]):
+                postings = trigrams.get(t)
+                if postings is None:
+                    postings = trigrams[t] = array.array('i')
+                postings.append(i)
+        self._ntrigrams = end
+        return end < len(self._paths)
+
+    def _regex_search(self, regex, joined, starts, limit=None):
+        """Search a regex in joined strings.
+
+        Return a {index:match_length} dict, with the shortest match of each
+        string.
+        """
+        ret = {}
+        for m in regex.finditer(joined):
+            i = bisect.bisect_right(starts, m.start()) - 1
+            span = m.end() - m.start()
+            if span < ret.get(i, span + 1):
+                ret[i] = span
+            if len(ret) == limit:
+                break
+        return ret
+
+    def prefix(self, pattern, limit=None):
+        """Return indexes of files whose basename starts with pattern.
+
+        Indexes are sorted by basename.
+        """
+        pattern = pattern.lower()
+        ret = []
+        for k in xrange(bisect.bisect_left(self._names, (pattern,)), len(self._names)):
+            name, i = self._names[k]
+            if not name.startswith(pattern) or len(ret) == limit:
+                break
+            ret.append(i)
+        return ret
+
+    def substring(self, pattern, limit=None):
+        """Return sorted indexes of files whose path contains pattern."""
+        pattern = pattern.lower()
+        if len(pattern) < 3 or self._ntrigrams < len(self._paths):
+            regex = re.compile(re.escape(pattern))
+            return sorted(self._regex_search(regex, self._joined_paths, self._path_starts, limit))
+        trigrams = set(pattern[k:k+3] for k in xrange(len(pattern) - 2))
+        candidates = min((self._trigrams.get(t, ()) for t in trigrams), key=len)
+        ret = []
+        for i in candidates:
+            if pattern in self._paths[i]:
+                ret.append(i)
+                if len(ret) == limit:
+                    break
+        return ret
+
+    def fuzzy(self, pattern, limit=None):
+        """Return indexes of files whose basename contains pattern characters.
+
+        Indexes are sorted by the length of the matching text, then by index.
+        If limit is set, only the first matches are ranked (see
+        fuzzy_scan_factor).
+        """
+        pattern = pattern.lower()
+        if not pattern:
+            return []
+        # each character is followed by anything but the next one: matching
+        # is linear, without backtracking
+        # The first character is not repeated before the second one: if a
+        # match exists, it starts at the last occurrence before the second
+        # character, and other attempts fail early.
+        gaps = [u'[^\n%s]*' % re.escape(n) for n in pattern[1:]]
+        if gaps:
+            gaps[0] = u'[^\n%s%s]*' % (re.escape(pattern[0]), re.escape(pattern[1]))
+        regex = re.compile(u''.join(re.escape(c) + g for c, g in zip(pattern, gaps)) + re.escape(pattern[-1]))
+        matches = self._regex_search(regex, self._joined_names, self._name_starts,
+                None if limit is None else limit * self.fuzzy_scan_factor)
+        ret = sorted(matches, key=lambda i: (matches[i], i))
+        return ret if limit is None else ret[:limit]
+
+    def search(self, pattern, limit=None):
+        """Search files using pattern syntax.
+
+        A pattern starting with '^' is a prefix search, a pattern starting
+        with '~' is a fuzzy search, other patterns are substring searches.
+        Return the list of matching file names.
+        """
+        if pattern.startswith('^'):
+            indexes = self.prefix(pattern[1:], limit)
+        elif pattern.startswith('~'):
+            indexes = self.fuzzy(pattern[1:], limit)
+        else:
+            indexes = self.substring(pattern, limit)
+        return [self.files[i] for i in indexes]
+
+
+class MarkupTemplate:
+    """Text template with %x fields, parsed once.
+
+    Field values are provided by getters, called only for fields used by the
+    template. Text is formatted again only if a field value changed.
+    Rendered text is an UTF-8 encoded string (like GLib.markup_escape_text()
+    results), unicode values are encoded.
+
+    Instance attributes:
+      fmt -- template string
+      fields -- set of fields used by the template
+      _parts -- template split on fields, fields at odd indexes
+      _values -- field values of the last rendering, or None
+      _text -- last rendered text
+    """
+
+    def __init__(self, fmt, fields):
+        self.fmt = fmt
+        if isinstance(fmt, unicode):
+            fmt = fmt.encode('utf-8')
+        pattern = re.compile('%([' + re.escape(fields) + '])')
+        self._parts = pattern.split(fmt)
+        self.fields = set(self._parts[1::2])
+        self._values = None
+        self._text = None
+
+    def render(self, getters):
+        """Return formatted text.
+
+        getters is a {field:callable} dict, callables return field values.
+        """
+        values = dict((f, getters[f]()) for f in self.fields)
+        if values != self._values:
+            parts = list(self._parts)
+            for i in xrange(1, len(parts), 2):
+                v = values[parts[i]]
+                parts[i] = v.encode('utf-8') if isinstance(v, unicode) else str(v)
+            self._text = ''.join(parts)
+            self._values = values
+        return self._text
+
+
+# Rotation angle to apply for EXIF orientation values
+exif_orientation_angles = {1: 0, 3: 180, 6: -90, 8: 90}
+
+
+class PixbufMemory:
+    """Accounting of memory used by pixbufs.
+
+    Memory is tracked by allocation category (e.g. displayed image, scaled
+    image, cache). Pixbufs of a category are replaced all at once.
+    Caches register evictors, called to free memory when budget is exceeded.
+
+    Instance attributes:
+      budget -- memory ceiling (in bytes), None for no limit
+      _usage -- used memory per category: {category:bytes}
+      _evictors -- list of (category, callback) pairs, callbacks free
+        memory of their category
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self._usage = {}
+        self._evictors = []
+
+    @staticmethod
+    def pixbuf_size(pb):
+        """Return memory used by pixel data of a pixbuf."""
+        return pb.get_rowstride() * pb.get_height()
+
+    def set(self, category, *pixbufs):
+        """Set pixbufs of a category (None values are ignored)."""
+        pbs = dict((id(pb), pb) for pb in pixbufs if pb is not None)  # no doublets
+        self._usage[category] = sum(self.pixbuf_size(pb) for pb in pbs.values())
+
+    def set_size(self, category, size):
+        """Set memory used by a category, in bytes."""
+        self._usage[category] = size
+
+    def usage(self, category=None):
+        """Return memory used by a category, or by all of them."""
+        if category is None:
+            return sum(self._usage.values())
+        return self._usage.get(category, 0)
+
+    def available(self, exclude=()):
+        """Return available memory, None if there is no budget.
+
+        Memory of categories in exclude is considered as free.
+        """
+        if self.budget is None:
+            return None
+        used = sum(v for k, v in self._usage.items() if k not in exclude)
+        return self.budget - used
+
+    def add_evictor(self, category, callback):
+        self._evictors.append((category, callback))
+
+    def reclaim(self, size, exclude=()):
+        """Evict caches until size bytes are available.
+
+        Return available memory, None if there is no budget.
+        """
+        for category, callback in self._evictors:
+            if self.budget is None or self.available(exclude) >= size:
+                break
+            if category not in exclude and self.usage(category):
+                callback()
+        return self.available(exclude)
 
 
 class AnimWrapperBase:
     """Wrapper interface for animations.
 
+    Constructor is called with the image filename, an optional iterable
+    over chunks of file data and an optional maximum number of pixels.
+    If data is provided (e.g. for archive members), it must be used instead of
+    reading the file. Images larger than the maximum number of pixels must be
+    loaded at a reduced resolution.
+
     The following instance methods must be defined:
       is_animated() -- return True for animated images
       pixbuf() -- return Pixbuf of the current frame
+      original_size() -- return image size, before any reduction
       advance() -- advance to the next frame
       duration() -- current frame duration in ms, -1 for infinite
       exif_orientation() -- return EXIF orientation integer value or None
@@ -29,15 +903,60 @@ class AnimWrapperGTK(AnimWrapperBase):
     Instance attributes:
       _animated -- value returned by is_animated()
       _pb -- value returned by pixbuf()
+      _size -- value returned by original_size()
       _t -- current display time, always increases (anim only)
       _it -- PixbufAnimationIter object (anim only)
     """
 
-    def __init__(self, fname):
+    # If True, files are mapped in memory and streamed to a PixbufLoader.
+    # Otherwise, reading is left to GdkPixbuf. Streaming does not avoid a
+    # copy: mapped data is copied to each chunk passed to the loader.
+    # The loader is selected like GdkPixbuf would, from the file. Scalable
+    # formats (e.g. SVG, which may reference relative files) are always read
+    # by GdkPixbuf, unless they have to be reduced.
+    mmap_input = False
+    # Formats whose loader buffers all streamed data and decodes it only once
+    # complete; they are always read by GdkPixbuf, which reads files more
+    # efficiently. Reduced images are loaded at scale.
+    buffered_formats = frozenset(['tiff'])
+
+    def __init__(self, fname, data=None, max_pixels=None):
+        self._size = None
+        def on_size(w, h):
+            self._size = (w, h)
+        mf = None
+        image_type = None
+        pb = None
         try:
-            ani = GdkPixbuf.PixbufAnimation.new_from_file(fname)
-        except GLib.Error as e:  # invalid format
+            if data is None and (self.mmap_input or max_pixels is not None):
+                fmt, w, h = GdkPixbuf.Pixbuf.get_file_info(fname)
+                if fmt is None:
+                    pass
+                elif fmt.get_name() in self.buffered_formats:
+                    if max_pixels is not None and w*h > max_pixels:
+                        k = math.sqrt(float(max_pixels)/(w*h))
+                        pb = GdkPixbuf.Pixbuf.new_from_file_at_scale(
+                            fname, max(1, int(w*k)), max(1, int(h*k)), False)
+                        self._size = (w, h)
+                elif max_pixels is not None or not fmt.is_scalable():
+                    image_type = fmt.get_name()
+                    mf = MappedFile(fname)
+                    data = mf.chunks()
+            if pb is not None:
+                ani = None
+            elif data is None:
+                ani = GdkPixbuf.PixbufAnimation.new_from_file(fname)
+            else:
+                ani = load_pixbuf_animation(data, max_pixels=max_pixels, on_size=on_size, image_type=image_type)
+        except (GLib.Error, ArchiveBase.LoadError, EnvironmentError) as e:  # invalid format
             raise self.LoadError(str(e))
+        finally:
+            if mf is not None:
+                mf.close()
+        if ani is None:
+            self._animated = False
+            self._pb = pb
+            return
         self._animated = not ani.is_static_image()
         if self._animated:
             self._t = 1  # 0.0 is a special value, avoid it
@@ -45,6 +964,8 @@ class AnimWrapperGTK(AnimWrapperBase):
             self._pb = self._it.get_pixbuf()
         else:
             self._pb = ani.get_static_image()
+        if self._size is None:
+            self._size = (self._pb.get_width(), self._pb.get_height())
 
     def is_animated(self):
         return self._animated
@@ -52,6 +973,9 @@ class AnimWrapperGTK(AnimWrapperBase):
     def pixbuf(self):
         return self._pb
 
+    def original_size(self):
+        return self._size
+
     def advance(self):
         if not self._animated:
             raise TypeError("cannot advance static images")
@@ -63,22 +987,880 @@ class AnimWrapperGTK(AnimWrapperBase):
             self._pb = self._it.get_pixbuf()
             return
 
-    def duration(self):
-        if not self._animated:
-            raise TypeError("cannot advance static images")
-        return self._it.get_delay_time()
+    def duration(self):
+        if not self._animated:
+            raise TypeError("cannot advance static images")
+        return self._it.get_delay_time()
+
+    def exif_orientation(self):
+        ret = self._pb.get_option('orientation')
+        if not ret:
+            return None
+        return int(ret)
+
+
+class AnimWrapperPixbuf(AnimWrapperBase):
+    """Static image wrapper for an already decoded pixbuf.
+
+    Instance attributes:
+      _pb -- value returned by pixbuf()
+      _orientation -- value returned by exif_orientation()
+    """
+
+    def __init__(self, pb, orientation=None):
+        self._pb = pb
+        self._orientation = orientation
+
+    def is_animated(self):
+        return False
+
+    def pixbuf(self):
+        return self._pb
+
+    def original_size(self):
+        return (self._pb.get_width(), self._pb.get_height())
+
+    def advance(self):
+        raise TypeError("cannot advance static images")
+
+    def duration(self):
+        raise TypeError("cannot advance static images")
+
+    def exif_orientation(self):
+        return self._orientation
+
+
+# Wrappers to use for each extensions
+anim_wrappers = {
+        None: AnimWrapperGTK,  # default
+        }
+
+
+def file_key(path, st_mtime, st_size, member=None):
+    """Return a key identifying a file content, for persistent caches.
+
+    For archive members, path, mtime and size are those of the archive.
+    """
+    s = repr((os.path.abspath(path), member, st_mtime, st_size))
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+
+class RawPixelCache:
+    """Disk cache of decoded images.
+
+    Each entry is a file holding a header followed by raw pixel data, keyed
+    by image path, modification time and size. Least recently used entries
+    are removed when the total size exceeds a limit; entry files are touched
+    when used, their modification time is the last use time.
+    Cache may be used from several threads.
+
+    Instance attributes:
+      path -- cache directory
+      max_size -- maximum total size of entries (in bytes)
+      _entries -- {entry_name:[size,last_use]}, None if not loaded yet
+      _total -- total size of entries
+      _lock -- lock for _entries
+    """
+
+    # magic, width, height, rowstride, n_channels, has_alpha, bits per sample,
+    # EXIF orientation (0 if none)
+    header = struct.Struct('<4sIIIBBBB')
+    magic = 'PIEW'
+    suffix = '.raw'
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self._entries = None
+        self._total = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def key(cls, file_key):
+        """Return the entry name of a file, from its file_key()."""
+        return file_key + cls.suffix
+
+    def _load(self):
+        """Load the list of entries, if needed (lock must be held)."""
+        if self._entries is not None:
+            return
+        self._entries = {}
+        try:
+            os.makedirs(self.path)
+        except OSError:
+            pass  # already exists, or errors when used
+        for name in os.listdir(self.path):
+            if not name.endswith(self.suffix):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            self._entries[name] = [st.st_size, st.st_mtime]
+        self._total = sum(v[0] for v in self._entries.values())
+
+    def get(self, key):
+        """Return a (pixbuf, orientation) pair for an entry, or None.
+
+        Pixel data is read and wrapped into a pixbuf without decoding. It is
+        copied twice: when read, and by PyGObject when building the
+        GLib.Bytes (a mapping of the entry would not avoid any copy).
+        """
+        fname = os.path.join(self.path, key)
+        with self._lock:
+            self._load()
+            if key not in self._entries:
+                return None
+            self._entries[key][1] = time.time()
+        try:
+            os.utime(fname, None)
+            with open(fname, 'rb') as f:
+                magic, w, h, rowstride, n, has_alpha, bits, orientation = \
+                        self.header.unpack(f.read(self.header.size))
+                data = f.read()
+            # check values, new_from_bytes() returns None on invalid ones
+            if (magic != self.magic or bits != 8 or n != (4 if has_alpha else 3)
+                    or w <= 0 or h <= 0 or rowstride < w * n
+                    or len(data) < rowstride * (h - 1) + w * n):
+                raise ValueError("invalid cache entry")
+            pb = GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(data), GdkPixbuf.Colorspace.RGB,
+                    bool(has_alpha), bits, w, h, rowstride)
+            if pb is None:
+                raise ValueError("cannot create pixbuf")
+        except (EnvironmentError, ValueError, struct.error) as e:
+            print "Invalid raw cache entry '%s': %s" % (fname, e)
+            self.remove(key)
+            return None
+        return pb, orientation or None
+
+    def put(self, key, pb, orientation=None):
+        """Add an entry, remove old entries if needed."""
+        fname = os.path.join(self.path, key)
+        header = self.header.pack(self.magic, pb.get_width(), pb.get_height(),
+                pb.get_rowstride(), pb.get_n_channels(), pb.get_has_alpha(),
+                pb.get_bits_per_sample(), orientation or 0)
+        with self._lock:
+            self._load()
+        tmp = '%s.%d.tmp' % (fname, threading.current_thread().ident)
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(header)
+                f.write(pb.get_pixels())
+            os.rename(tmp, fname)
+            size = os.path.getsize(fname)
+        except EnvironmentError as e:
+            print "Cannot write raw cache entry '%s': %s" % (fname, e)
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return
+        with self._lock:
+            old = self._entries.get(key)
+            if old is not None:
+                self._total -= old[0]
+            self._entries[key] = [size, time.time()]
+            self._total += size
+            if self._total <= self.max_size:
+                return
+            # remove least recently used entries
+            evicted = []
+            for name in sorted(self._entries, key=lambda k: self._entries[k][1]):
+                if self._total <= self.max_size:
+                    break
+                if name != key:
+                    self._total -= self._entries.pop(name)[0]
+                    evicted.append(name)
+        for name in evicted:
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+
+    def remove(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._total -= entry[0]
+        try:
+            os.remove(os.path.join(self.path, key))
+        except OSError:
+            pass
+
+
+class HammingIndex:
+    """Index of 64-bit hashes, for Hamming distance queries.
+
+    Hashes are split in m chunks: by pigeonhole principle, hashes at most
+    threshold bits apart have a chunk at most threshold//m bits apart.
+    For each chunk, values near each hash chunk are looked up in a table of
+    chunk values, then candidate pairs are checked.
+    The number of chunks is chosen from the number of hashes, to balance
+    the number of lookups and of candidates.
+    Requires numpy: lookups and checks are vectorized.
+
+    Instance attributes:
+      threshold -- maximum distance of matching hashes
+      _items -- indexed items
+      _hashes -- hashes of indexed items
+    """
+
+    # Maximum size of chunks, in bits (tables have 2**bits entries)
+    max_chunk_bits = 20
+    # Number of lookups and candidates processed at once
+    block_size = 1 << 21
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self._items = []
+        self._hashes = []
+
+    def add(self, item, h):
+        self._items.append(item)
+        self._hashes.append(h)
+
+    @staticmethod
+    def _count_near(bits, distance):
+        """Return the number of values at most distance bits from a value."""
+        ret, c = 0, 1
+        for k in range(min(bits, distance) + 1):
+            ret += c
+            c = c * (bits - k) // (k + 1)
+        return ret
+
+    def _chunk_count(self, n):
+        """Return the number of chunks to use for n hashes."""
+        def cost(m):
+            lookups = m * n * self._count_near(-(-64 // m), self.threshold // m)
+            return m * 2 ** -(-64 // m) + lookups * (1 + float(n) / 2 ** (64 // m))
+        return min(range(-(-64 // self.max_chunk_bits), 65), key=cost)
+
+    def pairs(self):
+        """Return matching pairs, as a (npairs,2) array of item indexes.
+
+        The lowest index is first. Pairs may be returned several times.
+        """
+        n = len(self._hashes)
+        hashes = numpy.array(self._hashes, numpy.uint64)
+        popcount8 = numpy.array([bin(i).count('1') for i in range(256)], numpy.uint8)
+        m = self._chunk_count(n)
+        ret = [numpy.zeros((0, 2), numpy.intp)]
+        for i in range(m):
+            lo, hi = 64 * i // m, 64 * (i+1) // m
+            chunks = ((hashes >> numpy.uint64(lo)) & numpy.uint64((1 << (hi - lo)) - 1)).astype(numpy.intp)
+            # items whose chunk value is v are order[first[v]:first[v+1]]
+            order = numpy.argsort(chunks, kind='mergesort')
+            first = numpy.zeros((1 << (hi - lo)) + 1, numpy.intp)
+            numpy.cumsum(numpy.bincount(chunks, minlength=1 << (hi - lo)), out=first[1:])
+            masks = numpy.array([sum(1 << b for b in bits)
+                                 for k in range(self.threshold // m + 1)
+                                 for bits in itertools.combinations(range(hi - lo), k)], numpy.intp)
+            step = max(1, int(self.block_size // (n * (1 + float(n) / len(first)))))
+            for j in range(0, len(masks), step):
+                block = masks[j:j+step]
+                values = (chunks[:, None] ^ block[None, :]).ravel()
+                starts = first[values]
+                counts = first[values + 1] - starts
+                total = counts.sum()
+                if not total:
+                    continue
+                # expand (item, matching range) to (item, other) pairs
+                a = numpy.repeat(numpy.arange(len(values)) // len(block), counts)
+                offsets = numpy.arange(total) - numpy.repeat(counts.cumsum() - counts, counts)
+                b = order[numpy.repeat(starts, counts) + offsets]
+                keep = a < b
+                a, b = a[keep], b[keep]
+                distances = popcount8[(hashes[a] ^ hashes[b]).view(numpy.uint8)].reshape(-1, 8).sum(axis=1)
+                keep = distances <= self.threshold
+                ret.append(numpy.column_stack((a[keep], b[keep])))
+        return numpy.concatenate(ret)
+
+    def groups(self):
+        """Return groups of near duplicate items, as sets.
+
+        Groups are transitive closures of matches, items without match are
+        not returned.
+        """
+        parent = {}
+        def find(x):
+            while parent.get(x, x) != x:
+                parent[x] = parent.get(parent[x], parent[x])  # path halving
+                x = parent[x]
+            return x
+        for a, b in self.pairs().tolist():
+            a, b = find(a), find(b)
+            if a != b:
+                parent[a] = b
+        groups = {}
+        for i in range(len(self._items)):
+            groups.setdefault(find(i), set()).add(self._items[i])
+        return [g for g in groups.values() if len(g) > 1]
+
+
+class HashStore:
+    """Persistent storage of perceptual hashes, in a SQLite database.
+
+    Hashes are indexed by file_key() values.
+    """
+
+    def __init__(self, path):
+        path = os.path.expanduser(path)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass  # already exists, or error when connecting
+        self._db = sqlite3.connect(path)
+        self._db.execute('CREATE TABLE IF NOT EXISTS hashes (key TEXT PRIMARY KEY, dhash INTEGER, phash INTEGER)')
+
+    # SQLite integers are signed
+    @staticmethod
+    def _to_db(h):
+        return h - (1 << 64) if h >= 1 << 63 else h
+
+    @staticmethod
+    def _from_db(h):
+        return h + (1 << 64) if h < 0 else h
+
+    def get(self, keys):
+        """Return known hashes of the given keys: {key:(dhash,phash)}."""
+        ret = {}
+        keys = list(keys)
+        for i in xrange(0, len(keys), 500):
+            batch = keys[i:i+500]
+            for key, dhash, phash in self._db.execute(
+                    'SELECT key, dhash, phash FROM hashes WHERE key IN (%s)' % ','.join('?' * len(batch)),
+                    batch):
+                ret[key] = (self._from_db(dhash), self._from_db(phash))
+        return ret
+
+    def put(self, items):
+        """Store hashes, items are (key, dhash, phash) tuples."""
+        with self._db:
+            self._db.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?)',
+                    [(k, self._to_db(d), self._to_db(p)) for k, d, p in items])
+
+
+class DecodeCostModel:
+    """Estimation of image decoding time, learnt from previous decodings.
+
+    Decoding time is modeled, per file extension, as a fixed overhead plus a
+    time proportional to the file size. The time per byte is averaged
+    exponentially. When file size is unknown, the average decoding time is
+    used instead.
+
+    Instance attributes:
+      _costs -- {ext:[time_per_byte, mean_time]}
+    """
+
+    # Fixed decoding overhead (in seconds)
+    overhead = 0.005
+    # Initial estimation of the time per byte (in seconds)
+    default_time_per_byte = 1 / 50e6
+    # Weight of new measures in averages
+    smoothing = 0.3
+
+    def __init__(self):
+        self._costs = {}
+
+    def _get(self, fname):
+        ext = os.path.splitext(fname)[1].lower()
+        if ext not in self._costs:
+            self._costs[ext] = [self.default_time_per_byte, None]
+        return self._costs[ext]
+
+    def estimate(self, fname, size=None):
+        """Return estimated decoding time of a file (in seconds)."""
+        per_byte, mean = self._get(fname)
+        if size is None:
+            return self.overhead if mean is None else mean
+        return self.overhead + size * per_byte
+
+    def record(self, fname, size, duration):
+        """Record the decoding time of a file."""
+        cost = self._get(fname)
+        k = self.smoothing
+        if size:
+            per_byte = max(0, duration - self.overhead) / size
+            cost[0] += k * (per_byte - cost[0])
+        cost[1] = duration if cost[1] is None else cost[1] + k * (duration - cost[1])
+
+
+class ImageDecoder:
+    """Background decoding of images.
+
+    Images are decoded by a worker thread, in request order. Decoded images
+    are kept until taken or discarded.
+
+    Instance attributes:
+      _open -- function decoding an image, called as open(fname, max_pixels)
+        in the worker thread, returning an AnimWrapper object
+      _on_decoded -- function called in the main loop with the file name,
+        after an image has been decoded
+      _queue -- queue of (fname, max_pixels) requests
+      _pending -- files requested but not decoded yet
+      _done -- decoded files: {fname:wrapper}, wrapper is a LoadError object
+        if decoding failed
+      _lock -- lock for _pending and _done
+      _thread -- worker thread, None if not started yet
+    """
+
+    def __init__(self, open_func, on_decoded):
+        self._open = open_func
+        self._on_decoded = on_decoded
+        self._queue = Queue.Queue()
+        self._pending = set()
+        self._done = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def request(self, fname, max_pixels=None):
+        """Request decoding of a file (ignored if already requested)."""
+        with self._lock:
+            if fname in self._pending or fname in self._done:
+                return
+            self._pending.add(fname)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='decoder')
+            self._thread.daemon = True
+            self._thread.start()
+        self._queue.put((fname, max_pixels))
+
+    def is_requested(self, fname):
+        return fname in self._pending or fname in self._done
+
+    def is_pending(self, fname):
+        return fname in self._pending
+
+    def is_ready(self, fname):
+        return fname in self._done
+
+    def take(self, fname):
+        """Remove a decoded image and return its wrapper.
+
+        Raise AnimWrapperBase.LoadError if image decoding failed.
+        """
+        with self._lock:
+            ani = self._done.pop(fname)
+        if isinstance(ani, AnimWrapperBase.LoadError):
+            raise ani
+        return ani
+
+    def decoded(self):
+        """Return the list of decoded wrappers."""
+        with self._lock:
+            return [v for v in self._done.values() if not isinstance(v, AnimWrapperBase.LoadError)]
+
+    def cancel(self, fname):
+        """Cancel decoding of a file."""
+        with self._lock:
+            self._pending.discard(fname)
+
+    def discard(self, keep=()):
+        """Discard decoded images and cancel requests, except for keep."""
+        with self._lock:
+            for f in self._done.keys():
+                if f not in keep:
+                    del self._done[f]
+            self._pending.intersection_update(keep)
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put((None, None))
+
+    def _run(self):
+        while True:
+            fname, max_pixels = self._queue.get()
+            if fname is None:
+                return
+            if fname not in self._pending:
+                continue  # cancelled
+            try:
+                ani = self._open(fname, max_pixels)
+            except AnimWrapperBase.LoadError as e:
+                ani = e
+            except Exception as e:
+                # unexpected error, must not stop the worker
+                ani = AnimWrapperBase.LoadError("%s: %s" % (e.__class__.__name__, e))
+            with self._lock:
+                if fname not in self._pending:
+                    continue  # cancelled while decoding
+                self._pending.discard(fname)
+                self._done[fname] = ani
+            GLib.idle_add(self._notify, fname)
+
+    def _notify(self, fname):
+        self._on_decoded(fname)
+        return False
+
+
+def _make_trash_dir(trash):
+    """Create a trash directory, if needed, and return it."""
+    for d in ('files', 'info'):
+        try:
+            os.makedirs(os.path.join(trash, d), 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    return trash
+
+def get_trash_dir(path):
+    """Return the trash directory to use for a file, and its top directory.
+
+    Following the freedesktop.org specification, the user's home trash is
+    used for files on the same filesystem; other files use a trash at the
+    top of their own filesystem ($topdir/.Trash/$uid, or $topdir/.Trash-$uid).
+    Files are thus always renamed, never copied.
+    Return a (trash, topdir) pair, topdir is None for the home trash.
+    Raise OSError if no trash can be used.
+    """
+
+    path = os.path.abspath(path)
+    dev = os.lstat(os.path.dirname(path)).st_dev
+    home_trash = os.path.join(os.environ.get('XDG_DATA_HOME') or os.path.expanduser('~/.local/share'), 'Trash')
+    try:
+        if os.stat(_make_trash_dir(home_trash)).st_dev == dev:
+            return home_trash, None
+    except OSError:
+        pass
+    # find the mount point of the file
+    topdir = os.path.dirname(path)
+    while topdir != os.path.dirname(topdir) and os.lstat(os.path.dirname(topdir)).st_dev == dev:
+        topdir = os.path.dirname(topdir)
+    uid = str(os.getuid())
+    shared = os.path.join(topdir, '.Trash')
+    try:
+        st = os.lstat(shared)
+        if stat.S_ISDIR(st.st_mode) and st.st_mode & stat.S_ISVTX:
+            return _make_trash_dir(os.path.join(shared, uid)), topdir
+    except OSError:
+        pass
+    return _make_trash_dir(os.path.join(topdir, '.Trash-' + uid)), topdir
+
+def trash_file(path):
+    """Move a file to the trash and return its new path.
+
+    Trash follows the freedesktop.org specification (see get_trash_dir()): a
+    .trashinfo file records the original path, so that file managers can
+    restore it.
+    """
+
+    path = os.path.abspath(path)
+    trash, topdir = get_trash_dir(path)
+    base = name = os.path.basename(path)
+    n = 1
+    while True:
+        # create the info file first, to reserve the name
+        info = os.path.join(trash, 'info', name + '.trashinfo')
+        try:
+            fd = os.open(info, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            break
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        n += 1
+        name = '%s.%d%s' % (os.path.splitext(base)[0], n, os.path.splitext(base)[1])
+    # paths are relative to the top directory in filesystem trashes
+    info_path = path if topdir is None else os.path.relpath(path, topdir)
+    with os.fdopen(fd, 'w') as f:
+        f.write('[Trash Info]\nPath=%s\nDeletionDate=%s\n' % (
+            urllib.quote(info_path.encode('utf-8') if isinstance(info_path, unicode) else info_path),
+            time.strftime('%Y-%m-%dT%H:%M:%S')))
+    trashed = os.path.join(trash, 'files', name)
+    try:
+        os.rename(path, trashed)
+    except Exception:
+        os.remove(info)
+        raise
+    return trashed
+
+def untrash_file(trashed, path):
+    """Restore a file moved to trash by trash_file()."""
+
+    if os.path.lexists(path):
+        raise OSError(errno.EEXIST, "File exists", path)
+    os.rename(trashed, path)
+    info = os.path.join(os.path.dirname(os.path.dirname(trashed)), 'info', os.path.basename(trashed) + '.trashinfo')
+    try:
+        os.remove(info)
+    except OSError:
+        pass
+
+
+class FileOperations:
+    """Background file operations.
+
+    Operations are (op, src, dst) tuples, op is one of:
+      trash -- move src to trash, dst is set to the trashed file path
+      move -- move src to dst
+      copy -- copy src to dst
+      untrash, unmove, uncopy -- undo the corresponding operation
+    Existing files are never overwritten.
+
+    Operations are processed in request order by a worker thread, by
+    batches. Results are reported in the main loop.
+
+    Instance attributes:
+      _on_done -- function called in the main loop after each batch, with the
+        list of (op, src, dst, tag, error) results and throughput of the
+        batch (in operations per second); error is None on success
+      _queue -- queue of (op, src, dst, tag) operations, tag is passed back
+        unchanged in results
+      pending -- number of submitted operations whose result has not been
+        reported yet
+      _thread -- worker thread, None if not started yet
+    """
+
+    # Maximum number of operations processed in a batch
+    batch_size = 64
+
+    def __init__(self, on_done):
+        self._on_done = on_done
+        self._queue = Queue.Queue()
+        self.pending = 0
+        self._thread = None
+
+    def submit(self, ops, tag=None):
+        """Queue a list of (op, src, dst) operations."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='fileops')
+            self._thread.daemon = True
+            self._thread.start()
+        self.pending += len(ops)
+        for op, src, dst in ops:
+            self._queue.put((op, src, dst, tag))
+
+    def stop(self):
+        """Stop the worker once queued operations are processed.
+
+        Return immediately, results of queued operations are still reported.
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread = None
+
+    @staticmethod
+    def apply(op, src, dst):
+        """Process an operation, return its (possibly updated) destination."""
+        if op == 'trash':
+            return trash_file(src)
+        elif op == 'untrash':
+            untrash_file(dst, src)
+        elif op in ('move', 'unmove', 'copy'):
+            if op == 'unmove':
+                src, dst = dst, src
+            if os.path.lexists(dst):
+                raise OSError(errno.EEXIST, "File exists", dst)
+            if op == 'copy':
+                shutil.copy2(src, dst)
+            else:
+                shutil.move(src, dst)
+        elif op == 'uncopy':
+            os.remove(dst)
+        else:
+            raise ValueError("invalid file operation: %s" % op)
+        return dst
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+            t0 = time.time()
+            results = []
+            for op, src, dst, tag in batch:
+                try:
+                    dst = self.apply(op, src, dst)
+                    results.append((op, src, dst, tag, None))
+                except (OSError, IOError, shutil.Error) as e:
+                    results.append((op, src, dst, tag, e))
+            if results:
+                rate = len(results) / max(time.time() - t0, 1e-3)
+                GLib.idle_add(self._notify, results, rate)
+            if stop:
+                return
+
+    def _notify(self, results, rate):
+        self.pending -= len(results)
+        self._on_done(results, rate)
+        return False
+
+
+class StripView:
+    """Continuous vertical strip of images.
+
+    Images are laid out end to end, scaled to the same width. Only images
+    around the viewport are kept in memory, scaled.
+    Position is stored as an image index and an offset in this image, so
+    that the view does not move when sizes of previous images become known.
+
+    Instance attributes:
+      count -- number of images
+      width -- width of images in the strip (in display pixels)
+      index -- index of the image at the top of the viewport
+      offset -- position of the viewport top in this image (display pixels)
+      scaled -- scaled images: {index:pixbuf}
+      _sizes -- original image sizes, when known: {index:(width,height)}
+      _ratio -- height/width ratio assumed for images of unknown size
+    """
+
+    def __init__(self, count, width, index=0):
+        self.count = count
+        self.width = width
+        self.index = index
+        self.offset = 0
+        self.scaled = {}
+        self._sizes = {}
+        self._ratio = 1.414  # portrait page, until a size is known
+
+    def set_width(self, width):
+        """Change width of images, drop scaled images."""
+        if width != self.width:
+            self.offset = self.offset * width // self.width
+            self.width = width
+            self.scaled = {}
+
+    def has_size(self, i):
+        return i in self._sizes
+
+    def size(self, i):
+        """Return the original size of an image, None if unknown."""
+        return self._sizes.get(i)
+
+    def set_size(self, i, w, h):
+        """Set the original size of an image."""
+        self._sizes[i] = (w, h)
+        self._ratio = float(h) / w
+
+    def height(self, i):
+        """Return height of an image in the strip."""
+        pb = self.scaled.get(i)
+        if pb is not None:
+            return pb.get_height()
+        w, h = self._sizes.get(i, (1, self._ratio))
+        return max(1, int(round(float(h) * self.width / w)))
+
+    def scroll(self, dy, view_h):
+        """Scroll the strip of dy pixels, for a viewport of height view_h."""
+        self.offset += dy
+        while self.offset < 0 and self.index > 0:
+            self.index -= 1
+            self.offset += self.height(self.index)
+        while self.index < self.count - 1 and self.offset >= self.height(self.index):
+            self.offset -= self.height(self.index)
+            self.index += 1
+        # stop at both strip ends
+        if self.offset < 0:
+            self.offset = 0
+        if self.index == self.count - 1:
+            self.offset = max(0, min(self.offset, self.height(self.index) - view_h))
+
+    def visible(self, view_h):
+        """Return images overlapping the viewport.
+
+        Return a list of (index, y) pairs, y being the position of the image
+        top in the viewport.
+        """
+        ret = []
+        i, y = self.index, -self.offset
+        while i < self.count and y < view_h:
+            ret.append((i, y))
+            y += self.height(i)
+            i += 1
+        return ret
+
+    def around(self, view_h, margin):
+        """Return indexes of images less than margin pixels from the viewport.
+
+        Visible images are returned first, then images after and before them.
+        """
+        visible = [i for i, y in self.visible(view_h)]
+        ret = list(visible)
+        if not visible:
+            return ret
+        last = visible[-1]
+        y = -self.offset + sum(self.height(i) for i in visible) - view_h
+        while last + 1 < self.count and y < margin:
+            last += 1
+            ret.append(last)
+            y += self.height(last)
+        first, y = visible[0], self.offset
+        while first > 0 and y < margin:
+            first -= 1
+            ret.append(first)
+            y += self.height(first)
+        return ret
+
+    def evict(self, keep):
+        """Drop scaled images, except those in keep."""
+        for i in self.scaled.keys():
+            if i not in keep:
+                del self.scaled[i]
+
+    def _renumber(self, count, new_index):
+        """Change the number of images, new_index maps indexes (or None)."""
+        for attr in ('scaled', '_sizes'):
+            d = getattr(self, attr)
+            setattr(self, attr, dict((new_index(i), v) for i, v in d.items() if new_index(i) is not None))
+        self.count = count
+
+    def remove(self, indexes):
+        """Remove images from the strip, given their sorted indexes.
+
+        If the top image is removed, the view moves to the top of the next
+        one.
+        """
+        removed = set(indexes)
+        if self.index in removed:
+            self.offset = 0
+        self.index -= bisect.bisect_left(indexes, self.index)
+        self._renumber(self.count - len(indexes),
+                       lambda i: None if i in removed else i - bisect.bisect_left(indexes, i))
+        self.index = max(0, min(self.index, self.count - 1))
+
+    def insert(self, indexes):
+        """Insert images in the strip, given their sorted new indexes."""
+        count = self.count + len(indexes)
+        inserted = set(indexes)
+        kept = [i for i in xrange(count) if i not in inserted]
+        self.index = kept[self.index]
+        self._renumber(count, lambda i: kept[i])
 
-    def exif_orientation(self):
-        ret = self._pb.get_option('orientation')
-        if not ret:
-            return None
-        return int(ret)
 
+class Slideshow:
+    """Slideshow schedule.
 
-# Wrappers to use for each extensions
-anim_wrappers = {
-        None: AnimWrapperGTK,  # default
-        }
+    Display deadlines are computed from a fixed origin, on the monotonic
+    clock: late displays do not delay the following ones.
+
+    Instance attributes:
+      interval -- display duration of each image (in seconds)
+      origin -- time of the first image display
+      index -- number of images displayed since origin
+      missed -- number of missed deadlines
+      task -- ID of the scheduled update, or None
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.origin = self.now()
+        self.index = 0
+        self.missed = 0
+        self.task = None
+
+    @staticmethod
+    def now():
+        """Return monotonic time (in seconds)."""
+        return GLib.get_monotonic_time() / 1e6
+
+    def deadline(self, k=1):
+        """Return display time of the k-th next image."""
+        return self.origin + (self.index + k) * self.interval
 
 
 class PiewApp:
@@ -89,7 +1871,9 @@ class PiewApp:
       img -- image widget
       info -- text information about displayed content
       pix_info -- text information about pixel
+      stats_info -- image statistics
       cmd -- command line entry
+      find_info -- results of the search being typed in cmd
       layout -- fixed widget which contains img and info
         The following extra attributes are set on layout:
           pos -- position of children (but img): {child:(x,y)}
@@ -99,13 +1883,64 @@ class PiewApp:
       zoom -- current zoom
       pos_x,pos_y -- current image position (pixel displayed at windows's center)
       files -- list of browsed files
+        Archive members are named after the archive path, as if the archive
+        was a directory.
       _files_orig -- original list of files (used for refresh)
+      _files_index -- FilenameIndex of files, removed files may still be in it
+      _files_index_task -- ID of the task building the trigram index, or None
+      _archive_members -- archive members in files: {fname:(archive,name)}
+      _file_position -- last known position of cur_file in files, or None
       cur_file -- displayed file, None (no file) or False (invalid file)
       _drag_x,_drag_y -- last drag position, or None
+      _press_x,_press_y -- position of the last button 1 press, or None
+      selection -- selected image region (x,y,width,height), or None
+      _select_start -- image position where selection started, or None
+      _stats_cache -- computed statistics: [pixbuf, {region:PixelStats}]
+      _templates -- compiled label formats: {attribute_name:MarkupTemplate}
+      _label_markups -- last markup set on labels: {label:markup}
       _last_w_s -- last window size, used to detect effecting resizing
       _redraw_task -- ID of scheduled redraw task, or None
+      _scale_buffers -- [(width,height,has_alpha), pixbuf, pixbuf], scaled image
+        buffers (see scale_pixbuf()), or None
+      _scale_pool -- thread pool used to scale images, or None
+      _ani_display -- (display_key, pixels) of the animation frame displayed
+        by ani_next_frame(), None if display has been redrawn since then
+        (pixels are None if the display key just changed)
+      _back_damage -- region of the image (as a rectangle) outside of which
+        the undisplayed scale buffer matches the displayed frame, None if
+        unknown
+      decoder -- ImageDecoder used to decode images in background
+      decode_costs -- DecodeCostModel, updated on each decoding
+      raw_cache -- RawPixelCache, None if disabled
+      _phashes -- perceptual hashes of files: {fname:(dhash,phash)}
+      _phash_thread -- thread getting perceptual hashes, or None
+      _phash_proc -- worker process computing perceptual hashes, or None
+      _dup_groups -- groups of near duplicate files (sorted lists), sorted by
+        first file, or None if must be computed
+      _dup_groups_gen -- generation of files and hashes, increased when
+        _dup_groups is invalidated
+      _dup_groups_thread -- thread computing _dup_groups, or None
+      _dup_groups_waiting -- callbacks waiting for _dup_groups
+      _slideshow -- Slideshow object, None if slideshow is stopped
+      marks -- set of marked files, targets of file operations
+      file_ops -- FileOperations processing file operations in background
+      _file_ops_rate -- throughput of the last batch of file operations
+      _file_ops_undo -- stack of completed file operations that can be
+        undone, grouped by user action: [[(op,src,dst)]]
+      _trash_confirm -- True if trashing marked files waits for confirmation
+      _quitting -- True if the application quits once file operations are
+        processed
+      strip -- StripView object in continuous strip mode, None otherwise
       _fullscreen -- window fullscreen state
       _mouse_x,_mouse_y -- current mouse position
+      memory -- PixbufMemory object, categories are:
+        image -- pixbuf provided by ani
+        rotated -- rotated copy of the image
+        display -- scaled image buffers
+        prefetch -- images decoded in background
+        strip -- scaled images of the strip
+      _image_state -- None, 'reduced' (image loaded with a reduced resolution)
+        or 'refused' (image not loaded due to memory budget)
 
     See configuration values, user events end commands for customization.
     """
@@ -116,6 +1951,7 @@ class PiewApp:
     w_default_size = (800, 500)
     default_files = [u'.']
     bg_color = Gdk.color_parse('black')
+    selection_color = Gdk.color_parse('yellow')
     start_fullscreen = False
 
     # Format of info label, with Pango markup
@@ -127,13 +1963,35 @@ class PiewApp:
     #   %n   position of current image in file list
     #   %N   file list size
     #   %%   literal '%'
-    info_format = '<span font_desc="Sans 10" color="green">%f  ( %w x %h )  [ %n / %N ]  %z %%</span>'
+    #   %S   image state (see info_txt_reduced_image and info_txt_refused_image)
+    #   %m   pixbuf memory usage (in MB), with budget if set
+    #   %D   slideshow state (see info_txt_slideshow)
+    #   %M   marks (see info_txt_marked and info_txt_marks)
+    #   %O   file operations state (see info_txt_file_ops)
+    info_format_fields = 'fwhznNSmDMO%'
+    info_format = '<span font_desc="Sans 10" color="green">%f%M  ( %w x %h )%S  [ %n / %N ]  %z %%  %m%D%O</span>'
     # Info label position (offset from top left corner)
     # Negative positions are relative to the opposite side.
     info_position = (10, 5)
     # Filename substitutes for invalid files (Pango markup)
     info_txt_no_image = '<i>no file</i>'
     info_txt_bad_image = '<i>invalid file format</i>'
+    # Image state substitutes (Pango markup)
+    info_txt_reduced_image = ' <i>reduced</i>'
+    info_txt_refused_image = ' <i>not enough memory</i>'
+    # Slideshow state, empty if stopped (Pango markup)
+    # Formatted with interval (in seconds) and number of missed deadlines.
+    info_txt_slideshow = '  <b>slideshow</b> %gs (%d missed)'
+    # Marks: substitute for marked files, and number of marked files, empty if
+    # there is no mark (Pango markup)
+    info_txt_marked = ' <b>*</b>'
+    info_txt_marks = '  <b>%d marked</b>'
+    # Marks: request to confirm trashing of marked files (Pango markup)
+    # Formatted with the number of marked files.
+    info_txt_trash_confirm = '  <b>Delete again to trash %d marked files</b>'
+    # File operations state, empty if there is no pending operation (Pango markup)
+    # Formatted with number of pending operations and throughput.
+    info_txt_file_ops = '  <b>%d pending</b> (%.1f files/s)'
 
     # Format of information about pixel under the cursor
     # If cursor is not on the image, an empty string is returned.
@@ -143,15 +2001,33 @@ class PiewApp:
     #   %H           same as %h but uppercase
     #   %i,%I        same as %h and %H but without alpha channel
     #   %x,%y        pixel position
+    pix_info_format_fields = 'xyrgbahHiI%'
     pix_info_format = '<span color="magenta">( %x , %y ) <tt> <span background="#%I">  </span> #%H  <span color="red">%r</span> <span color="green">%g</span> <span color="blue">%b</span> <span color="white">%a</span></tt></span>'
     # Pixel Info label position (offset from top left corner)
     # Negative positions are relative to the opposite side.
     pix_info_position = (10, 30)
 
+    # Format of image statistics, with Pango markup
+    # %s is replaced by the statistics table.
+    stats_info_format = '<span font_desc="Monospace 9" color="yellow" background="#00000080">%s</span>'
+    # Image statistics position (offset from top left corner)
+    # Negative positions are relative to the opposite side.
+    stats_info_position = (10, 55)
+
     # Command line position
     # Negative positions are relative to the opposite side.
     cmd_position = (0, -1)
 
+    # Format of search results displayed while typing a 'find' command
+    # %s is replaced by the list of results, the first one is highlighted.
+    find_info_format = '<span font_desc="Sans 10" color="white" background="#00000080">%s</span>'
+    find_info_first_format = '<b>%s</b>'
+    # Search results position
+    # Negative positions are relative to the opposite side.
+    find_info_position = (10, -40)
+    # Maximum number of displayed search results
+    find_info_max_results = 10
+
     # Step (in pixels) when moving around with arrow keys
     # Keys are GDK Modifier masks (None for default value).
     move_step = {
@@ -187,6 +2063,59 @@ class PiewApp:
     #interp_type = GdkPixbuf.InterpType.NEAREST
     interp_type = GdkPixbuf.InterpType.BILINEAR
 
+    # Number of threads used to scale images, None to use one per core
+    scale_threads = None
+    # Minimum height (in pixels) of bands scaled by each thread
+    scale_band_min_height = 64
+
+    # Number of files, after and before the current one, to preload in page
+    # cache (0 to disable)
+    prefetch_count = 3
+
+    # Memory budget for pixbufs (in bytes), None for no limit
+    # When exceeded, caches are evicted and images are loaded at a reduced
+    # resolution.
+    memory_budget = None
+    # Minimum number of pixels of reduced images
+    # Images are not loaded if there is not enough memory to reach it.
+    memory_min_pixels = 640 * 480
+
+    # Directory of the cache of decoded images, None to disable it
+    # Images long to decode are stored decoded in this directory.
+    raw_cache_dir = None
+    # Maximum size of the decoded images cache (in bytes)
+    raw_cache_size = 4 << 30
+    # Minimum decoding time of images stored in the cache (in seconds)
+    raw_cache_min_time = 0.5
+
+    # Near duplicates: database of perceptual hashes
+    phash_db = '~/.cache/piew/phash.sqlite'
+    # Near duplicates: hash to compare, 'dhash' or 'phash'
+    duplicate_hash = 'phash'
+    # Near duplicates: maximum number of different bits between hashes
+    duplicate_threshold = 6
+    # Near duplicates: number of hashing processes, None to use one per core
+    phash_jobs = None
+
+    # Slideshow: default display duration of each image (in seconds)
+    slideshow_interval = 5
+    # Slideshow: number of upcoming images decoded in advance
+    slideshow_lookahead = 2
+    # Slideshow: extra time given to decoding, in addition to its estimated
+    # duration (in seconds)
+    slideshow_margin = 0.2
+    # Slideshow: deadlines are missed if images are displayed later than this
+    # delay (in seconds)
+    slideshow_tolerance = 0.05
+
+    # Strip mode: maximum width of images, None to use window's width
+    strip_max_width = None
+    # Strip mode: images less than this distance from the viewport are decoded
+    # and kept in memory (in screen heights)
+    strip_margin = 1.5
+    # Strip mode: color of images not decoded yet (RGBA value)
+    strip_placeholder_color = 0x202020ff
+
     # Frame duration of infinite frames (in ms)
     # Animation could stop at the last frame (without looping).
     # This value provides a finite display time for such frames.
@@ -201,6 +2130,32 @@ class PiewApp:
 
     def __init__(self, files=None):
         self.cur_file = None
+        self._file_position = None
+        self.memory = PixbufMemory(self.memory_budget)
+        self.memory.add_evictor('prefetch', self.evict_prefetched)
+        self.memory.add_evictor('strip', self.evict_strip)
+        self._image_state = None
+        self.decoder = ImageDecoder(self.open_image, self.event_image_decoded)
+        self.decode_costs = DecodeCostModel()
+        self.raw_cache = None
+        if self.raw_cache_dir is not None:
+            self.raw_cache = RawPixelCache(os.path.expanduser(self.raw_cache_dir), self.raw_cache_size)
+        self._slideshow = None
+        self.marks = set()
+        self.file_ops = FileOperations(self.event_file_ops_done)
+        self._file_ops_rate = 0
+        self._file_ops_undo = []
+        self._trash_confirm = False
+        self._quitting = False
+        self.strip = None
+        self._files_index_task = None
+        self._phashes = {}
+        self._phash_thread = None
+        self._phash_proc = None
+        self._dup_groups = None
+        self._dup_groups_gen = 0
+        self._dup_groups_thread = None
+        self._dup_groups_waiting = []
         if files is None or len(files) == 0:
             files = self.default_files
         self.set_filelist(files)
@@ -222,10 +2177,19 @@ class PiewApp:
         self.pix_info.set_use_markup(True)
         self.pix_info.set_use_underline(False)
         self.pix_info.set_markup('')
+        self.stats_info = Gtk.Label()
+        self.stats_info.set_use_markup(True)
+        self.stats_info.set_use_underline(False)
+        self.stats_info.set_no_show_all(True)
 
         self.cmd = Gtk.Entry()
         self.cmd.set_no_show_all(True)
         self.cmd.connect('activate', self.event_cmd_activate)
+        self.cmd.connect('changed', self.event_cmd_changed)
+        self.find_info = Gtk.Label()
+        self.find_info.set_use_markup(True)
+        self.find_info.set_use_underline(False)
+        self.find_info.set_no_show_all(True)
 
         self.img = Gtk.Image()
         self.pb = self.empty_pixbuf
@@ -237,11 +2201,14 @@ class PiewApp:
         self.layout.pos = {
                 self.info: self.info_position,
                 self.pix_info: self.pix_info_position,
+                self.stats_info: self.stats_info_position,
                 self.cmd: self.cmd_position,
+                self.find_info: self.find_info_position,
                 }
         for w, pos in self.layout.pos.items():
             self.layout.put(w, *pos)
         self.layout.set_size_request(*self.w_min_size)
+        self.layout.connect_after('draw', self.event_draw_selection)
 
 
         self.w.add_events(Gdk.EventMask.BUTTON_PRESS_MASK | Gdk.EventMask.BUTTON_RELEASE_MASK | Gdk.EventMask.POINTER_MOTION_MASK | Gdk.EventMask.SCROLL_MASK)
@@ -255,9 +2222,19 @@ class PiewApp:
         self.w.connect('window-state-event', self.event_window_state)
 
         self._redraw_task = None
+        self._scale_buffers = None
+        self._scale_pool = None
+        self._ani_display = None
+        self._back_damage = None
         self._fullscreen = None
         self._mouse_x, self._mouse_y = 0, 0
         self._drag_x, self._drag_y = None, None
+        self._press_x, self._press_y = None, None
+        self.selection = None
+        self._select_start = None
+        self._stats_cache = [None, {}]
+        self._templates = {}
+        self._label_markups = {}
         self._last_w_s = 0, 0  # force resize event to occur at startup
         self.pos_x, self.pos_y = 0, 0
         self.zoom = 1
@@ -274,116 +2251,921 @@ class PiewApp:
             findex = 0
         self.change_file(findex, False)
 
-    def main(self):
-        Gtk.main()
+    def main(self):
+        Gtk.main()
+
+    def quit(self, *args):
+        self.slideshow(False)
+        self.decoder.stop()
+        if self._phash_proc is not None:
+            self._phash_proc.terminate()
+        if self._scale_pool is not None:
+            self._scale_pool.terminate()
+        self.file_ops.stop()
+        if self.file_ops.pending:
+            # don't block the main loop, results are still processed
+            print "Waiting for %d file operations" % self.file_ops.pending
+            self._quitting = True
+            self.w.hide()
+            return
+        Gtk.main_quit()
+
+
+    # File related methods
+
+    def set_filelist(self, files=None):
+        """Set or reload list of image files.
+
+        Directories are opened and images they contain are added.
+        Archives are handled like directories.
+        If files is None, the original filelist is reloaded.
+        Doublets are removed, files are sorted (string comparaison).
+        """
+
+        if files is not None:
+            self._files_orig = files
+        if self.strip is not None:
+            # strip indexes are invalidated, image is reloaded by the caller
+            self.strip = None
+            self.memory.set('strip')
+        self.files, self._archive_members = find_image_files(self._files_orig, self.file_exts)
+        self.update_files_index()
+
+    def update_files_index(self):
+        """Index files, after a change of the file list."""
+
+        self.invalidate_dup_groups()
+        self._files_index = FilenameIndex(self.files)
+        if self._files_index_task is not None:
+            GLib.source_remove(self._files_index_task)
+        self._files_index_task = GLib.idle_add(self.build_files_index, priority=GLib.PRIORITY_LOW)
+
+    def build_files_index(self):
+        """Build the trigram index of files, by steps.
+
+        Returns True while the index is not complete (to be used as glib
+        event callback).
+        """
+
+        if self._files_index.build_trigrams(2000):
+            return True
+        self._files_index_task = None
+        return False
+
+    def find_files(self, pattern, limit=None):
+        """Search files of the list by name.
+
+        See FilenameIndex.search() for pattern syntax.
+        pattern may be an UTF-8 string (e.g. from a Gtk.Entry).
+        """
+
+        if isinstance(pattern, str):
+            pattern = pattern.decode('utf-8', 'replace')
+        # index may contain removed files, which are filtered out: request
+        # enough results to still get limit files
+        index = self._files_index
+        index_limit = limit
+        if limit is not None:
+            index_limit += max(0, len(index.files) - len(self.files))
+        ret = []
+        for f in index.search(pattern, index_limit):
+            k = bisect.bisect_left(self.files, f)
+            if k < len(self.files) and self.files[k] == f:
+                ret.append(f)
+                if len(ret) == limit:
+                    break
+        return ret
+
+    def get_file_position(self):
+        """Return the position of the current file in the list, or None.
+
+        Position is cached, and looked up by bisection when the list or the
+        current file changed (the list is sorted).
+        """
+
+        f = self.cur_file
+        if not f:
+            return None
+        files = self.files
+        n = self._file_position
+        if n is None or n >= len(files) or files[n] != f:
+            n = bisect.bisect_left(files, f)
+            if n >= len(files) or files[n] != f:
+                try:
+                    n = files.index(f)
+                except ValueError:
+                    n = None
+            self._file_position = n
+        return n
+
+    def change_file(self, n=0, rel=True, adjust=True):
+        """Change current file.
+
+        n is the filelist position, relative to current position if rel is True.
+        If adjust is True, zoom is adjusted.
+        Absolute and relative positions wrap around the bounds of the list.
+        On error the first file is loaded.
+        """
+
+        if len(self.files) == 0:
+            f = None
+        else:
+            try:
+                if rel:
+                    if self.cur_file is None:
+                        f = self.files[0]
+                    n += self.files.index(self.cur_file)
+                f = self.files[n % len(self.files)]
+            except ValueError:
+                f = self.files[0]
+        if self.strip is not None:
+            # jump to the top of the image
+            self.strip.index, self.strip.offset = self.files.index(f), 0
+            self.cur_file = f
+            self.refresh()
+            return
+        self.load_image(f)
+        if adjust:
+            self.zoom_adjust()
+        self.prefetch()
+
+    def prefetch(self):
+        """Preload files around the current one in page cache.
+
+        Files following the current one are preloaded first.
+        """
+
+        if not self.prefetch_count or not self.cur_file:
+            return
+        try:
+            n = self.files.index(self.cur_file)
+        except ValueError:
+            return
+        nfiles = len(self.files)
+        done = set([self.cur_file])
+        for i in range(1, self.prefetch_count + 1):
+            for f in (self.files[(n+i) % nfiles], self.files[(n-i) % nfiles]):
+                if f in done:
+                    continue
+                done.add(f)
+                if f not in self._archive_members:
+                    warm_file_cache(f)
+
+    def load_image(self, fname):
+        """Load a given image.
+
+        If fname is None, display will be cleared and info text will be properly
+        set.
+        """
+
+        self.ani_set_state(False)
+        self.ani = None
+        self.pb = None
+        self.memory.set('image')
+        self.memory.set('rotated')
+        self._image_state = None
+        self.set_selection(None)
+        if fname is None:
+            self.pb = self.empty_pixbuf
+        else:
+            try:
+                if self.decoder.is_ready(fname):
+                    self.ani = self.decoder.take(fname)
+                    self.update_prefetch_memory()
+                else:
+                    self.decoder.cancel(fname)  # don't decode it twice
+                    member = self._archive_members.get(fname)
+                    max_pixels = self.get_max_image_pixels(fname if member is None else None)
+                    if max_pixels is not None and max_pixels < self.memory_min_pixels:
+                        print "Image '%s' not loaded: not enough memory" % fname
+                        self._image_state = 'refused'
+                    else:
+                        self.ani = self.open_image(fname, max_pixels)
+            except AnimWrapperBase.LoadError as e:  # invalid format
+                print "Invalid image '%s': %s" % (fname, e)
+                self.ani = None
+            if self._image_state == 'refused':
+                self.pb = self.empty_pixbuf
+            elif self.ani is not None:
+                self.pb = self.ani.pixbuf()
+                if self.ani.is_animated():
+                    self._ani_task = None
+                    self.ani_update()  # start animation
+            else:
+                self.pb = self.empty_pixbuf
+                fname = False
+        self.cur_file = fname
+        if self.ani:
+            self.memory.set('image', self.pb)
+            if self.ani.original_size() != (self.pb.get_width(), self.pb.get_height()):
+                self._image_state = 'reduced'
+            angle = exif_orientation_angles.get(self.ani.exif_orientation())
+            if angle:
+                self.rotate(angle)
+        self.move()
+
+    def open_image(self, fname, max_pixels=None):
+        """Decode an image and return its AnimWrapper.
+
+        Decoding time is recorded in decode_costs.
+        Static images long to decode are stored in (and retrieved from) the
+        raw cache, if enabled.
+        May be called from any thread.
+        """
+
+        ext = os.path.splitext(fname)[1].lower()
+        if ext not in anim_wrappers:
+            ext = None
+        member = self._archive_members.get(fname)
+        cache_key = None
+        if self.raw_cache is not None:
+            key = self.get_file_key(fname)
+            cache_key = key and RawPixelCache.key(key)
+            cached = cache_key and self.raw_cache.get(cache_key)
+            if cached:
+                pb, orientation = cached
+                if max_pixels is None or pb.get_width() * pb.get_height() <= max_pixels:
+                    return AnimWrapperPixbuf(pb, orientation)
+
+        t0 = time.time()
+        if member is None:
+            ani = anim_wrappers[ext](fname, None, max_pixels)
+        else:
+            archive, name = member
+            ani = anim_wrappers[ext](fname, archive.read(name), max_pixels)
+        t = time.time() - t0
+        self.decode_costs.record(fname, self.get_file_size(fname), t)
+        if (cache_key is not None and t >= self.raw_cache_min_time and
+                not ani.is_animated() and
+                ani.original_size() == (ani.pixbuf().get_width(), ani.pixbuf().get_height())):
+            self.raw_cache.put(cache_key, ani.pixbuf(), ani.exif_orientation())
+        return ani
+
+    def get_file_key(self, fname):
+        """Return file_key() of a file of the list, None on error."""
+
+        member = self._archive_members.get(fname)
+        try:
+            st = os.stat(fname if member is None else member[0].path)
+        except OSError:
+            return None
+        return file_key(fname, st.st_mtime, st.st_size, member and member[1])
+
+    def get_file_size(self, fname):
+        """Return size of a file of the list, None if unknown."""
+
+        member = self._archive_members.get(fname)
+        try:
+            if member is None:
+                return os.path.getsize(fname)
+            archive, name = member
+            return archive.size(name)
+        except (OSError, KeyError):
+            return None
+
+    def prefetch_image(self, fname):
+        """Request background decoding of an image.
+
+        Return False if there is not enough memory to decode it.
+        """
+
+        if self.decoder.is_requested(fname):
+            return True
+        max_pixels = None
+        available = self.memory.available()
+        if available is not None:
+            max_pixels = max(0, available) // (2 * 4)
+            if max_pixels < self.memory_min_pixels:
+                return False
+        self.decoder.request(fname, max_pixels)
+        return True
+
+    def update_prefetch_memory(self):
+        self.memory.set('prefetch', *[ani.pixbuf() for ani in self.decoder.decoded()])
+
+    def evict_prefetched(self):
+        self.decoder.discard()
+        self.update_prefetch_memory()
+
+    def event_image_decoded(self, fname):
+        """Called when an image has been decoded in background."""
+
+        if self.strip is not None:
+            self.refresh()  # decoded images are taken when redrawing
+        self.update_prefetch_memory()
+        if self._slideshow is not None and self._slideshow.task is None:
+            self.slideshow_update()  # waiting for this image
+
+    def get_max_image_pixels(self, fname=None):
+        """Return the maximum number of pixels of an image to load.
+
+        Return None if there is no limit, or if the image fits in memory.
+        If fname is set, size of the image is read to evict only needed caches.
+        Displayed image is assumed to be released.
+        """
+
+        if self.memory.budget is None:
+            return None
+        # keep room for a rotated copy
+        exclude = ('image', 'rotated')
+        need = None
+        if fname is not None:
+            fmt, w, h = GdkPixbuf.Pixbuf.get_file_info(fname)
+            if fmt is not None:
+                need = 2 * 4 * w * h
+        if need is None:
+            need = self.memory.budget  # unknown size, free as much as possible
+        available = self.memory.reclaim(need, exclude)
+        if available >= need:
+            return None
+        return max(0, available) // (2 * 4)
+
+    def ani_update(self):
+        """Advance animation.
+
+        If a task has been defined, animation is advanced to the next frame.
+        Schedule next update.
+        Always returns False (to be used as glib event callback).
+        """
+
+        if self.ani is None:
+            return
+        if self._ani_task is not None:
+            self.ani_next_frame()
+        t = self.ani.duration()
+        if t == -1:
+            t = self.ani_infinite_frame_duration
+        self._ani_task = GLib.timeout_add(t, self.ani_update)
+        return False
+
+
+    def get_upcoming_files(self, n):
+        """Return the n files following the current one (or less)."""
+
+        if not self.files:
+            return []
+        try:
+            cur = self.files.index(self.cur_file)
+        except ValueError:
+            cur = -1
+        n = min(n, len(self.files) - 1 if cur >= 0 else len(self.files))
+        return [self.files[(cur + k) % len(self.files)] for k in range(1, n + 1)]
+
+    def slideshow(self, state=None, interval=None):
+        """Start or stop slideshow.
+
+        state values:
+            None -- toggle slideshow
+            True -- start slideshow, or change its interval
+            False -- stop slideshow
+        Slideshow cannot be started in strip mode.
+        """
+
+        if state is None:
+            state = self._slideshow is None
+        if state and self.strip is not None:
+            print "Cannot start slideshow in strip mode"
+            return
+        if self._slideshow is not None:
+            if self._slideshow.task is not None:
+                GLib.source_remove(self._slideshow.task)
+            self._slideshow = None
+        if state:
+            self._slideshow = Slideshow(interval or self.slideshow_interval)
+            self.slideshow_update()
+        self.redraw_info()
+
+    def slideshow_update(self):
+        """Update slideshow.
+
+        Decoding of upcoming images is started in time for their display
+        deadline, according to decoding time estimations. If an image is not
+        decoded on time, it is displayed as soon as it is.
+        Next update is scheduled at the next deadline or decoding start.
+        Always returns False (to be used as glib event callback).
+        """
+
+        ss = self._slideshow
+        ss.task = None
+        upcoming = self.get_upcoming_files(self.slideshow_lookahead)
+        if not upcoming:
+            self.slideshow(False)
+            return False
+
+        now = ss.now()
+        if now >= ss.deadline():
+            if self.decoder.is_pending(upcoming[0]):
+                return False  # wait for decoding (see event_image_decoded())
+            late = now - ss.deadline()
+            if late > self.slideshow_tolerance:
+                ss.missed += 1
+                print "Slideshow: '%s' displayed %d ms late" % (upcoming[0], late * 1000)
+            ss.index += 1
+            if late > ss.interval:
+                # don't try to catch up, restart from now
+                ss.origin = now - ss.index * ss.interval
+            self.change_file(+1)
+            upcoming = self.get_upcoming_files(self.slideshow_lookahead)
+
+        # drop images which are not upcoming anymore (e.g. after a file change)
+        self.decoder.discard(set(upcoming))
+        self.update_prefetch_memory()
+        # start decodings, compute next wake-up time
+        wakeup = ss.deadline()
+        for k, f in enumerate(upcoming, 1):
+            if self.decoder.is_requested(f) or f == self.cur_file:
+                continue
+            cost = self.decode_costs.estimate(f, self.get_file_size(f))
+            start = ss.deadline(k) - cost - self.slideshow_margin
+            if start <= ss.now():
+                self.prefetch_image(f)
+            else:
+                wakeup = min(wakeup, start)
+        delay = max(0, wakeup - ss.now())
+        ss.task = GLib.timeout_add(int(delay * 1000) + 1, self.slideshow_update)
+        return False
+
+
+    def set_strip_mode(self, state=None):
+        """Enable or disable continuous strip mode.
+
+        In strip mode, images of the file list are displayed end to end in a
+        vertical strip, scaled to the window's width. self.pb is empty:
+        actions on the current image (rotation, statistics, pixel info) are
+        disabled.
+        state values:
+            None -- toggle mode
+            True -- enable strip mode
+            False -- disable strip mode
+        """
+
+        if state is None:
+            state = self.strip is None
+        if bool(state) == (self.strip is not None):
+            return
+        if state:
+            if not self.files:
+                return
+            try:
+                index = self.files.index(self.cur_file)
+            except ValueError:
+                index = 0
+            self.slideshow(False)
+            self.strip = StripView(len(self.files), self.get_strip_width(), index)
+            # single image is released, actions on it are disabled
+            self.redraw_stats_info(False)
+            self.pix_info.hide()
+            self.load_image(None)
+        else:
+            cur_file = self.cur_file
+            self.strip = None
+            self.decoder.discard()
+            self.update_prefetch_memory()
+            self.memory.set('strip')
+            if cur_file:
+                self.change_file(self.files.index(cur_file), False)
+
+    def get_strip_width(self):
+        w_sx = self.w.get_size()[0]
+        return min(w_sx, self.strip_max_width or w_sx)
+
+    def scale_strip_image(self, ani):
+        """Return the image of a wrapper, rotated and scaled for the strip."""
+
+        pb = ani.pixbuf()
+        angle = exif_orientation_angles.get(ani.exif_orientation())
+        if angle:
+            pb = pb.rotate_simple(angle % 360)
+        w, h = pb.get_width(), pb.get_height()
+        k = float(self.strip.width) / w
+        dst = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8,
+                                   self.strip.width, max(1, int(round(h * k))))
+        if pb.get_has_alpha():
+            dst.fill(self.strip_placeholder_color)
+            pb.composite(dst, 0, 0, dst.get_width(), dst.get_height(),
+                         0, 0, k, k, self.interp_type, 255)
+        else:
+            pb.scale(dst, 0, 0, dst.get_width(), dst.get_height(),
+                     0, 0, k, k, self.interp_type)
+        return dst
+
+    def redraw_strip(self):
+        """Redraw the image strip.
+
+        Images around the viewport are decoded in background, and scaled when
+        decoded. Other images are evicted.
+        """
+
+        st = self.strip
+        w_sx, w_sy = self.w.get_size()
+        st.set_width(self.get_strip_width())
+        around = st.around(w_sy, int(self.strip_margin * w_sy))
+        # get decoded images, request the other ones
+        for i in around:
+            if i in st.scaled:
+                continue
+            f = self.files[i]
+            if self.decoder.is_ready(f):
+                try:
+                    ani = self.decoder.take(f)
+                except AnimWrapperBase.LoadError as e:
+                    print "Invalid image '%s': %s" % (f, e)
+                    st.scaled[i] = self.empty_pixbuf.scale_simple(st.width, 1, self.interp_type)
+                    continue
+                w, h = ani.original_size()
+                if exif_orientation_angles.get(ani.exif_orientation()) in (90, -90):
+                    w, h = h, w
+                st.set_size(i, w, h)
+                st.scaled[i] = self.scale_strip_image(ani)
+            else:
+                if not st.has_size(i) and f not in self._archive_members:
+                    fmt, w, h = GdkPixbuf.Pixbuf.get_file_info(f)
+                    if fmt is not None:
+                        st.set_size(i, w, h)
+                self.prefetch_image(f)
+        st.evict(around)
+        self.decoder.discard([self.files[i] for i in around])
+        self.update_prefetch_memory()
+        self.memory.set('strip', *st.scaled.values())
+
+        # sizes may have changed, clamp position again
+        st.scroll(0, w_sy)
+        dst = self.get_display_buffer(st.width, w_sy, False)
+        dst.fill(self.strip_placeholder_color)
+        cur = None
+        for i, y in st.visible(w_sy):
+            pb = st.scaled.get(i)
+            h = st.height(i)
+            if y <= w_sy // 2 < y + h or cur is None:
+                cur = i
+            if pb is None:
+                continue
+            y0, y1 = max(0, -y), min(h, w_sy - y)
+            pb.copy_area(0, y0, st.width, y1 - y0, dst, 0, y + y0)
+        self.cur_file = self.files[cur]
+        self.img.set_from_pixbuf(dst)
+        self.layout.move(self.img, (w_sx - st.width) / 2, 0)
+        self.redraw_info()
+
+    def evict_strip(self):
+        """Drop scaled strip images which are not visible."""
+
+        if self.strip is not None:
+            self.strip.evict([i for i, y in self.strip.visible(self.w.get_size()[1])])
+            self.memory.set('strip', *self.strip.scaled.values())
+
+
+    def dups_index(self):
+        """Compute perceptual hashes of files, in background.
+
+        A thread gets file keys (which requires a stat() of each file) and
+        reads known hashes from the database. Other hashes are computed by a
+        worker process (see phash_worker_main()), started with a fresh
+        interpreter: forking this process, which runs threads, could
+        deadlock. New hashes are stored in the database by the thread.
+        """
+
+        if numpy is None:
+            raise RuntimeError("near duplicates search requires numpy")
+        if self._phash_thread is not None:
+            return  # already running
+        files = [f for f in self.files if f not in self._phashes]
+        members = dict((f, _worker_member(self._archive_members, f))
+                       for f in files if f in self._archive_members)
+        self._phash_thread = threading.Thread(target=self._phash_run, args=(files, members), name='phash')
+        self._phash_thread.daemon = True
+        self._phash_thread.start()
+
+    def _phash_run(self, files, members):
+        """Get perceptual hashes of files, run by the thread of dups_index()."""
+
+        try:
+            self._phash_run_steps(files, members)
+        except Exception as e:
+            print "Cannot compute perceptual hashes: %s" % e
+        finally:
+            GLib.idle_add(self.event_phashes, [], True)
+
+    def _phash_run_steps(self, files, members):
+        store = HashStore(self.phash_db)
+        keys = {}
+        for f in files:
+            key = self.get_file_key(f)
+            if key is not None:
+                keys[f] = key
+        known = store.get(keys.values())
+        todo = [f for f, key in keys.items() if key not in known]
+        print "Perceptual hashes: %d known, %d to compute" % (len(keys) - len(todo), len(todo))
+        GLib.idle_add(self.event_phashes, [(f, known[k]) for f, k in keys.items() if k in known], False)
+
+        if todo:
+            proc = self._phash_proc = subprocess.Popen(
+                    [sys.executable, os.path.abspath(__file__), 'phash-worker',
+                     '-j', str(self.phash_jobs or multiprocessing.cpu_count())],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            # worker reads all tasks before writing any result
+            pickle.dump([(f, members.get(f)) for f in todo], proc.stdin, pickle.HIGHEST_PROTOCOL)
+            proc.stdin.close()
+            # gather results by batches, process them in the main loop
+            batch = []
+            t = time.time()
+            while True:
+                try:
+                    fname, dhash, phash, error = pickle.load(proc.stdout)
+                except EOFError:
+                    break
+                if error is not None:
+                    print "Cannot hash '%s': %s" % (fname, error)
+                    continue
+                batch.append((fname, (dhash, phash)))
+                if time.time() - t >= 0.5:
+                    store.put((keys[f], d, p) for f, (d, p) in batch)
+                    GLib.idle_add(self.event_phashes, batch, False)
+                    batch = []
+                    t = time.time()
+            store.put((keys[f], d, p) for f, (d, p) in batch)
+            GLib.idle_add(self.event_phashes, batch, False)
+            proc.wait()
+
+    def event_phashes(self, hashes, done):
+        """Add perceptual hashes computed in background.
+
+        hashes is a list of (fname, (dhash, phash)) pairs.
+        Always returns False (to be used as glib event callback).
+        """
+
+        if hashes:
+            self._phashes.update(hashes)
+            self.invalidate_dup_groups()
+        if done:
+            self._phash_thread = self._phash_proc = None
+            print "Perceptual hashes: done"
+            if self._dup_groups_waiting:
+                self.compute_dup_groups()
+        return False
+
+    def invalidate_dup_groups(self):
+        """Drop groups of near duplicates, after a change of files or hashes."""
+
+        self._dup_groups = None
+        self._dup_groups_gen += 1
+        if self._dup_groups_waiting:
+            self.compute_dup_groups()
+
+    def with_dup_groups(self, callback):
+        """Call callback with groups of near duplicate files.
+
+        Groups (see _dup_groups) are computed in background, if needed, once
+        perceptual hashes are computed.
+        """
+
+        if self._dup_groups is not None:
+            callback(self._dup_groups)
+            return
+        if self._dup_groups_waiting:
+            pass
+        elif self._phash_thread is not None:
+            print "Searching near duplicates, once perceptual hashes are computed..."
+        else:
+            print "Searching near duplicates..."
+        self._dup_groups_waiting.append(callback)
+        self.compute_dup_groups()
+
+    def compute_dup_groups(self):
+        """Start computation of groups of near duplicates, in a thread.
+
+        Nothing is done while perceptual hashes are being computed: groups
+        would be outdated by each batch of hashes.
+        """
+
+        if self._dup_groups_thread is not None:
+            return  # results will be dropped if outdated, and computed again
+        if self._phash_thread is not None:
+            return  # computed when hashes are done
+        n = ('dhash', 'phash').index(self.duplicate_hash)
+        files = set(self.files)
+        items = [(f, h[n]) for f, h in self._phashes.items() if f in files]
+        gen = self._dup_groups_gen
+        threshold = self.duplicate_threshold
+        def run():
+            index = HammingIndex(threshold)
+            for f, h in items:
+                index.add(f, h)
+            groups = sorted(sorted(g) for g in index.groups())
+            GLib.idle_add(self.event_dup_groups, groups, gen)
+        self._dup_groups_thread = threading.Thread(target=run, name='dups')
+        self._dup_groups_thread.daemon = True
+        self._dup_groups_thread.start()
+
+    def event_dup_groups(self, groups, gen):
+        """Process groups of near duplicates computed in background.
+
+        Always returns False (to be used as glib event callback).
+        """
+
+        self._dup_groups_thread = None
+        if gen != self._dup_groups_gen:
+            # files or hashes changed meanwhile
+            if self._dup_groups_waiting:
+                self.compute_dup_groups()
+            return False
+        self._dup_groups = groups
+        callbacks, self._dup_groups_waiting = self._dup_groups_waiting, []
+        for callback in callbacks:
+            callback(groups)
+        return False
+
+    def dups_goto(self, step=1):
+        """Go to the first file of the next (or previous) group of duplicates."""
 
-    def quit(self, *args):
-        Gtk.main_quit()
+        self.with_dup_groups(lambda groups: self._dups_goto(groups, step))
 
+    def _dups_goto(self, groups, step):
+        if not groups:
+            print "No near duplicates found"
+            return
+        firsts = [g[0] for g in groups]
+        cur = self.cur_file or u''
+        # group of the current file, or insertion position
+        k = bisect.bisect_right(firsts, cur) - 1
+        if k >= 0 and cur in groups[k]:
+            k = (k + step) % len(groups)
+        elif step > 0:
+            k = (k + 1) % len(groups)
+        else:
+            k %= len(groups)
+        self.change_file(self.files.index(firsts[k]), False)
 
-    # File related methods
+    def dups_filter(self):
+        """Keep only the first file of each group of near duplicates.
 
-    def set_filelist(self, files=None):
-        """Set or reload list of image files.
+        Use set_filelist() to restore the whole list.
+        """
 
-        Directories are opened and images they contain are added.
-        If files is None, the original filelist is reloaded.
-        Doublets are removed, files are sorted (string comparaison).
+        self.with_dup_groups(self._dups_filter)
+
+    def _dups_filter(self, groups):
+        removed = {}  # {fname:kept_fname}
+        for g in groups:
+            removed.update((f, g[0]) for f in g[1:])
+        if not removed:
+            return
+        self.set_strip_mode(False)
+        self.files = [f for f in self.files if f not in removed]
+        self.update_files_index()
+        print "%d near duplicates hidden" % len(removed)
+        if self.cur_file in removed:
+            self.change_file(self.files.index(removed[self.cur_file]), False)
+        else:
+            self.redraw_info()
+
+    def mark(self, files=None, state=None):
+        """Mark or unmark files.
+
+        files defaults to the current file.
+        state values:
+            None -- toggle marks
+            True -- mark files
+            False -- unmark files
         """
 
-        if files is not None:
-            self._files_orig = files
-        self.files = set() # not doublets
-        for f in self._files_orig:
-            f = unicode(os.path.normpath(unicode(f)))
-            if os.path.isfile(f):
-                self.files.add(f)
-            if os.path.isdir(f):
-                for ff in sorted(os.listdir(f)):
-                    if f != '.':
-                        ff = os.path.join(f, ff)
-                    if os.path.isfile(ff):
-                        self.files.add(ff)
-        # convert to a list, filter, sort
-        self.files = sorted(f for f in self.files if f.split('.')[-1].lower() in self.file_exts)
+        if files is None:
+            files = [self.cur_file] if self.cur_file else []
+        for f in files:
+            if state is None:
+                if f in self.marks:
+                    self.marks.remove(f)
+                else:
+                    self.marks.add(f)
+            elif state:
+                self.marks.add(f)
+            else:
+                self.marks.discard(f)
+        self.redraw_info()
 
-    def change_file(self, n=0, rel=True, adjust=True):
-        """Change current file.
+    def file_operation(self, op, dst_dir=None):
+        """Apply an operation on marked files, or on the current file.
 
-        n is the filelist position, relative to current position if rel is True.
-        If adjust is True, zoom is adjusted.
-        Absolute and relative positions wrap around the bounds of the list.
-        On error the first file is loaded.
+        op is 'trash', 'move' or 'copy' (see FileOperations).
+        Files are processed in background. Trashed and moved files are
+        removed from the file list immediately, and put back on error.
+        Marks of processed files are cleared.
         """
 
-        if len(self.files) == 0:
-            f = None
+        files = sorted(self.marks) if self.marks else [self.cur_file] if self.cur_file else []
+        members = [f for f in files if f in self._archive_members]
+        for f in members:
+            print "Cannot process archive member '%s'" % f
+        files = [f for f in files if f not in self._archive_members]
+        if not files:
+            return
+        if op == 'trash':
+            ops = [(op, f, None) for f in files]
+        elif dst_dir is None:
+            raise ValueError("destination directory required")
         else:
-            try:
-                if rel:
-                    if self.cur_file is None:
-                        f = self.files[0]
-                    n += self.files.index(self.cur_file)
-                f = self.files[n % len(self.files)]
-            except ValueError:
-                f = self.files[0]
-        self.load_image(f)
-        if adjust:
-            self.zoom_adjust()
+            dst_dir = os.path.expanduser(dst_dir)
+            if not os.path.isdir(dst_dir):
+                raise ValueError("not a directory: %s" % dst_dir)
+            ops = [(op, f, os.path.join(dst_dir, os.path.basename(f))) for f in files]
+        self.marks.difference_update(files)
+        action = []
+        self._file_ops_undo.append(action)
+        self.file_ops.submit(ops, action)
+        if op != 'copy':
+            self.remove_files(files)
+        self.redraw_info()
 
-    def load_image(self, fname):
-        """Load a given image.
+    def undo_file_operation(self):
+        """Undo the last file operation action."""
 
-        If fname is None, display will be cleared and info text will be properly
-        set.
+        if self.file_ops.pending:
+            print "Cannot undo while file operations are pending"
+            return
+        if not self._file_ops_undo:
+            print "Nothing to undo"
+            return
+        action = self._file_ops_undo.pop()
+        self.file_ops.submit([('un' + op, src, dst) for op, src, dst in reversed(action)])
+        self.redraw_info()
+
+    def remove_files(self, files):
+        """Remove files from the file list, change the current file if needed.
+
+        Strip mode is kept, unless all files are removed.
         """
 
-        self.ani_set_state(False)
-        self.ani = None
-        self.pb = None
-        if fname is None:
-            self.pb = self.empty_pixbuf
-        else:
-            ext = os.path.splitext(fname)[1].lower()
-            if ext not in anim_wrappers:
-                ext = None
-            try:
-                self.ani = anim_wrappers[ext](fname)
-            except AnimWrapperBase.LoadError as e:  # invalid format
-                print "Invalid image '%s': %s" % (fname, e)
-                self.ani = None
-            if self.ani is not None:
-                self.pb = self.ani.pixbuf()
-                if self.ani.is_animated():
-                    self._ani_task = None
-                    self.ani_update()  # start animation
+        files = set(files)
+        cur_file = self.cur_file
+        removed = [i for i, f in enumerate(self.files) if f in files]
+        if len(removed) == len(self.files):
+            self.set_strip_mode(False)
+        self.files = [f for f in self.files if f not in files]
+        # removed files are filtered out of search results, index is kept
+        self.invalidate_dup_groups()
+        if self.strip is not None:
+            self.strip.remove(removed)
+            self.cur_file = self.files[self.strip.index]
+            self.refresh()
+        elif cur_file in files:
+            if not self.files:
+                self.load_image(None)
             else:
-                self.pb = self.empty_pixbuf
-                fname = False
-        self.cur_file = fname
-        if self.ani:
-            angle = {1: 0, 3: 180, 6: -90, 8: 90}.get(self.ani.exif_orientation())
-            if angle:
-                self.rotate(angle)
-        self.move()
+                k = bisect.bisect_left(self.files, cur_file)
+                self.change_file(min(k, len(self.files) - 1), False)
 
-    def ani_update(self):
-        """Advance animation.
+    def insert_files(self, files):
+        """Insert files back in the file list.
 
-        If a task has been defined, animation is advanced to the next frame.
-        Schedule next update.
-        Always returns False (to be used as glib event callback).
+        Files are added to the current index, which is not rebuilt.
         """
 
-        if self.ani is None:
+        inserted = set()
+        for f in files:
+            k = bisect.bisect_left(self.files, f)
+            if k == len(self.files) or self.files[k] != f:
+                self.files.insert(k, f)
+                inserted.add(f)
+        if not inserted:
             return
-        if self._ani_task is not None:
-            self.ani_next_frame()
-        t = self.ani.duration()
-        if t == -1:
-            t = self.ani_infinite_frame_duration
-        self._ani_task = GLib.timeout_add(t, self.ani_update)
-        return False
+        self.invalidate_dup_groups()
+        self._files_index.add(sorted(inserted))
+        if self._files_index_task is None:
+            self._files_index_task = GLib.idle_add(self.build_files_index, priority=GLib.PRIORITY_LOW)
+        if self.strip is not None:
+            self.strip.insert([i for i, f in enumerate(self.files) if f in inserted])
+            self.refresh()
+        elif self.cur_file is None:
+            self.change_file(0, False)
+
+    def event_file_ops_done(self, results, rate):
+        """Update file list and undo data after file operations."""
+
+        if self._quitting:
+            for op, src, dst, action, error in results:
+                if error is not None:
+                    print "Cannot %s '%s': %s" % (op, src, error)
+            if not self.file_ops.pending:
+                Gtk.main_quit()
+            return
+        self._file_ops_rate = rate
+        restored = []
+        for op, src, dst, action, error in results:
+            if error is not None:
+                print "Cannot %s '%s': %s" % (op, src, error)
+                if op in ('trash', 'move'):
+                    restored.append(src)
+                continue
+            if action is not None:
+                action.append((op, src, dst))
+            if op in ('untrash', 'unmove'):
+                restored.append(src)
+        if restored:
+            self.insert_files(restored)
+        if not self.file_ops.pending:
+            # drop empty actions, to undo what has been done
+            self._file_ops_undo = [a for a in self._file_ops_undo if a]
+        self.redraw_info()
 
 
     # Drawing methods
@@ -401,73 +3183,231 @@ class PiewApp:
         Always returns False (to be used as glib event callback).
         """
 
-        w_sx, w_sy = self.w.get_size()
-        img_sx, img_sy = self.pb.get_width(), self.pb.get_height()
-        pb = self.pb
+        if self.strip is not None:
+            self.redraw_strip()
+            self._redraw_task = None
+            return False
 
-        src_sx, src_sy = w_sx/self.zoom, w_sy/self.zoom
-        if src_sx < img_sx or src_sy < img_sy:
-            src_x = max(0, int(self.pos_x-src_sx/2))
-            src_y = max(0, int(self.pos_y-src_sy/2))
-            pb = pb.new_subpixbuf(
-                    src_x, src_y,
-                    int(min(src_sx, img_sx-src_x)),
-                    int(min(src_sy, img_sy-src_y))
-                    )
+        w_sx, w_sy = self.w.get_size()
+        pb, dst_sx, dst_sy = self.get_display_region()
+        self._ani_display = self._back_damage = None
 
         #XXX display with NEAREST filter and schedule a 'nice' redraw
         if self.zoom != 1:
-            dst_sx = int(self.zoom*pb.get_width())
-            dst_sy = int(self.zoom*pb.get_height())
-            pb = pb.scale_simple(
-                    min(w_sx, dst_sx), min(w_sy, dst_sy),
-                    self.interp_type
-                    )
+            pb = self.scale_pixbuf(pb, dst_sx, dst_sy)
 
         self.img.set_from_pixbuf(pb)
+        if self.zoom == 1 and self._scale_buffers is not None:
+            # release unused buffers
+            self._scale_buffers = None
+            self.memory.set('display')
 
         # Center image
         self.layout.move(self.img, (w_sx-pb.get_width())/2, (w_sy-pb.get_height())/2)
 
         self.redraw_info()
+        if self.stats_info.get_visible():
+            self.redraw_stats_info()
 
         # stop scheduled task
         self._redraw_task = None
         return False
 
+    def get_display_region(self):
+        """Return the visible part of the image and its displayed size.
+
+        Return a (pixbuf, width, height) tuple.
+        """
+
+        src_x, src_y, src_sx, src_sy, dst_sx, dst_sy = self.get_display_rect()
+        pb = self.pb
+        if (src_sx, src_sy) != (pb.get_width(), pb.get_height()):
+            pb = pb.new_subpixbuf(src_x, src_y, src_sx, src_sy)
+        return pb, dst_sx, dst_sy
+
+    def get_display_rect(self):
+        """Return the position of the visible part of the image.
+
+        Return a (x, y, width, height, displayed_width, displayed_height)
+        tuple.
+        """
+
+        w_sx, w_sy = self.w.get_size()
+        img_sx, img_sy = self.pb.get_width(), self.pb.get_height()
+
+        src_x, src_y = 0, 0
+        src_sx, src_sy = w_sx/self.zoom, w_sy/self.zoom
+        if src_sx < img_sx or src_sy < img_sy:
+            src_x = max(0, int(self.pos_x-src_sx/2))
+            src_y = max(0, int(self.pos_y-src_sy/2))
+            src_sx = int(min(src_sx, img_sx-src_x))
+            src_sy = int(min(src_sy, img_sy-src_y))
+        else:
+            src_sx, src_sy = img_sx, img_sy
+        dst_sx = min(w_sx, int(self.zoom*src_sx))
+        dst_sy = min(w_sy, int(self.zoom*src_sy))
+        return src_x, src_y, src_sx, src_sy, max(1, dst_sx), max(1, dst_sy)
+
+    def get_display_key(self):
+        """Return a value identifying how the image is displayed.
+
+        Return None if the image is not scaled to a display buffer (only
+        scaled images can be partially redrawn).
+        """
+
+        if self.strip is not None or self.zoom == 1 or self._scale_buffers is None:
+            return None
+        return (self.w.get_size(), self.zoom, self.pos_x, self.pos_y,
+                self.pb.get_width(), self.pb.get_height(), self.pb.get_has_alpha(),
+                self.interp_type)
+
+    def redraw_damage(self, rect):
+        """Redraw the changed region of the image, given as a rectangle.
+
+        The region is scaled to the undisplayed buffer, which is then
+        displayed. The caller must ensure that, outside of rect, the buffer
+        already matches the image.
+        """
+
+        src_x, src_y, src_sx, src_sy, dst_sx, dst_sy = self.get_display_rect()
+        kx = float(dst_sx) / src_sx
+        ky = float(dst_sy) / src_sy
+        # enlarge the region to cover interpolation filter footprint
+        x0, y0, x1, y1 = rect
+        dx0 = max(0, int(math.floor((x0 - 2 - src_x) * kx)) - 2)
+        dy0 = max(0, int(math.floor((y0 - 2 - src_y) * ky)) - 2)
+        dx1 = min(dst_sx, int(math.ceil((x1 + 2 - src_x) * kx)) + 2)
+        dy1 = min(dst_sy, int(math.ceil((y1 + 2 - src_y) * ky)) + 2)
+        if dx0 >= dx1 or dy0 >= dy1:
+            return False  # region is not visible
+        pb = self.pb
+        if (src_sx, src_sy) != (pb.get_width(), pb.get_height()):
+            pb = pb.new_subpixbuf(src_x, src_y, src_sx, src_sy)
+        dst = self.get_display_buffer(dst_sx, dst_sy, pb.get_has_alpha())
+        pb.scale(dst, dx0, dy0, dx1-dx0, dy1-dy0, 0, 0, kx, ky, self.interp_type)
+        self.img.set_from_pixbuf(dst)
+        if self.stats_info.get_visible():
+            self.redraw_stats_info()
+        return True
+
+    def get_display_buffer(self, width, height, has_alpha):
+        """Return a preallocated pixbuf to draw the displayed image.
+
+        Two buffers are used alternately: the returned one is not displayed.
+        """
+
+        key = (width, height, has_alpha)
+        if self._scale_buffers is None or self._scale_buffers[0] != key:
+            self._scale_buffers = None
+            self.memory.set('display')  # previous buffers are released
+            self._scale_buffers = [key] + [
+                    GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, has_alpha, 8, width, height)
+                    for i in range(2)]
+            self.memory.set('display', *self._scale_buffers[1:])
+        bufs = self._scale_buffers
+        dst = bufs[1]
+        bufs[1], bufs[2] = bufs[2], bufs[1]
+        return dst
+
+    def scale_pixbuf(self, pb, dst_sx, dst_sy, nthreads=None):
+        """Scale a pixbuf for display.
+
+        The result is written to one of two preallocated buffers, used
+        alternately (the displayed buffer is never modified).
+        Scaling is split in horizontal bands, processed by nthreads threads
+        (default is scale_threads).
+        """
+
+        dst = self.get_display_buffer(dst_sx, dst_sy, pb.get_has_alpha())
+        kx = float(dst_sx) / pb.get_width()
+        ky = float(dst_sy) / pb.get_height()
+        if nthreads is None:
+            nthreads = self.scale_threads or multiprocessing.cpu_count()
+        nbands = max(1, min(nthreads, dst_sy // self.scale_band_min_height))
+        bounds = [dst_sy * i // nbands for i in range(nbands + 1)]
+        def scale_band(i):
+            y0, y1 = bounds[i], bounds[i+1]
+            pb.scale(dst, 0, y0, dst_sx, y1-y0, 0, 0, kx, ky, self.interp_type)
+        if nbands == 1:
+            scale_band(0)
+        else:
+            if self._scale_pool is None:
+                self._scale_pool = multiprocessing.pool.ThreadPool(
+                        self.scale_threads or multiprocessing.cpu_count())
+            self._scale_pool.map(scale_band, range(nbands))
+        return dst
+
     def redraw_info(self):
         """Redraw image info."""
 
-        self.info.set_markup(self.format_info())
+        self.set_label_markup(self.info, self.format_info())
+
+    def set_label_markup(self, label, markup):
+        """Set label markup, if changed."""
+
+        if self._label_markups.get(label) != markup:
+            label.set_markup(markup)
+            self._label_markups[label] = markup
+
+    def get_template(self, name):
+        """Return the MarkupTemplate for a format attribute.
+
+        Template is compiled again when the format changes.
+        """
+
+        fmt = getattr(self, name)
+        tpl = self._templates.get(name)
+        if tpl is None or tpl.fmt != fmt:
+            tpl = MarkupTemplate(fmt, getattr(self, name + '_fields'))
+            self._templates[name] = tpl
+        return tpl
 
     def format_info(self):
         """Return Pango markup for self.info."""
 
-        # Get formatting data
-        d = {
-                'w': self.pb.get_width(),
-                'h': self.pb.get_height(),
-                'z': int(self.zoom * 100),
-                'N': len(self.files),
-                '%': '%',
-                }
-        # Filename
-        if self.cur_file is None:
-            d['f'] = self.info_txt_no_image
-        elif self.cur_file is False:
-            d['f'] = self.info_txt_bad_image
-        else:
-            d['f'] = GLib.markup_escape_text(self.cur_file)
-        # File position
-        try:
-            d['n'] = self.files.index(self.cur_file) + 1
-        except ValueError:
-            d['n'] = '?'
-
-        # Format
-        return re.sub('%(['+''.join(d.keys())+'])',
-                      lambda m: str(d[m.group(1)]),
-                      self.info_format)
+        def filename():
+            if self.cur_file is None:
+                return self.info_txt_no_image
+            elif self.cur_file is False:
+                return self.info_txt_bad_image
+            return GLib.markup_escape_text(self.cur_file)
+        def file_position():
+            n = self.get_file_position()
+            return '?' if n is None else n + 1
+        def image_size(n):
+            if self.strip is None:
+                return (self.pb.get_width(), self.pb.get_height())[n]
+            size = self.strip.size(self.get_file_position())
+            return '?' if size is None else size[n]
+        return self.get_template('info_format').render({
+                'f': filename,
+                'w': lambda: image_size(0),
+                'h': lambda: image_size(1),
+                'z': lambda: int(self.zoom * 100),
+                'n': file_position,
+                'N': lambda: len(self.files),
+                'S': lambda: {
+                    'reduced': self.info_txt_reduced_image,
+                    'refused': self.info_txt_refused_image,
+                    }.get(self._image_state, ''),
+                'm': self.format_memory,
+                'D': lambda: '' if self._slideshow is None else self.info_txt_slideshow % (
+                    self._slideshow.interval, self._slideshow.missed),
+                'M': lambda: (self.info_txt_marked if self.cur_file in self.marks else '') + (
+                    self.info_txt_marks % len(self.marks) if self.marks else '') + (
+                    self.info_txt_trash_confirm % len(self.marks) if self._trash_confirm else ''),
+                'O': lambda: self.info_txt_file_ops % (
+                    self.file_ops.pending, self._file_ops_rate) if self.file_ops.pending else '',
+                '%': lambda: '%',
+                })
+
+    def format_memory(self):
+        """Return pixbuf memory usage, as text."""
+
+        s = '%d' % (self.memory.usage() >> 20)
+        if self.memory.budget is not None:
+            s += '/%d' % (self.memory.budget >> 20)
+        return s + ' MB'
 
     def redraw_pix_info(self, pos=None):
         """Redraw pixel info."""
@@ -476,12 +3416,14 @@ class PiewApp:
         if s is None:
             self.pix_info.hide()
         else:
-            self.pix_info.set_markup(s)
+            self.set_label_markup(self.pix_info, s)
             self.pix_info.show()
 
     def format_pix_info(self, pos=None):
         """Return Pango markup for pixel info."""
 
+        if self.strip is not None:
+            return None
         if pos is None:
             pos = self.get_cursor_pixel()
             if pos is None:
@@ -493,23 +3435,74 @@ class PiewApp:
         colors = self.get_pixel_color(*pos)
         if len(colors) < 3:
             return '' # should not happen with normal images
-        # Get formatting data
-        d = {
-                'x': pos[0], 'y': pos[1],
-                'r': colors[0],
-                'g': colors[1],
-                'b': colors[2],
-                'a': '' if len(colors) < 4 else colors[3],
-                'h': ''.join('%02x' % c for c in colors),
-                'H': ''.join('%02X' % c for c in colors),
-                'i': ''.join('%02x' % c for c in colors[:3]),
-                'I': ''.join('%02X' % c for c in colors[:3]),
-                '%': '%',
-                }
-        # Format
-        return re.sub('%(['+''.join(d.keys())+'])',
-                      lambda m: str(d[m.group(1)]),
-                      self.pix_info_format)
+        return self.get_template('pix_info_format').render({
+                'x': lambda: pos[0],
+                'y': lambda: pos[1],
+                'r': lambda: colors[0],
+                'g': lambda: colors[1],
+                'b': lambda: colors[2],
+                'a': lambda: '' if len(colors) < 4 else colors[3],
+                'h': lambda: ''.join('%02x' % c for c in colors),
+                'H': lambda: ''.join('%02X' % c for c in colors),
+                'i': lambda: ''.join('%02x' % c for c in colors[:3]),
+                'I': lambda: ''.join('%02X' % c for c in colors[:3]),
+                '%': lambda: '%',
+                })
+
+    def get_stats(self, region=None):
+        """Return PixelStats of the current image.
+
+        Statistics are cached until the image changes.
+        """
+
+        if self._stats_cache[0] is not self.pb:
+            self._stats_cache = [self.pb, {}]
+        cache = self._stats_cache[1]
+        if region not in cache:
+            cache[region] = PixelStats(self.pb, region)
+        return cache[region]
+
+    def redraw_stats_info(self, state=True):
+        """Redraw image statistics, or hide them if state is False.
+
+        Statistics are computed on the selection, if any.
+        """
+
+        if not state or self.strip is not None:
+            self.stats_info.hide()
+            return
+        self.set_label_markup(self.stats_info, self.format_stats_info())
+        self.stats_info.show()
+
+    def format_stats_info(self):
+        """Return Pango markup for image statistics."""
+
+        return self.stats_info_format % GLib.markup_escape_text(self.format_stats())
+
+    def format_stats(self):
+        """Return image statistics, as text."""
+
+        if self.selection is None:
+            region = None
+        else:
+            # clamp selection to the image
+            x, y, w, h = self.selection
+            img_sx, img_sy = self.pb.get_width(), self.pb.get_height()
+            x, y = max(0, min(x, img_sx-1)), max(0, min(y, img_sy-1))
+            w, h = max(1, min(w, img_sx-x)), max(1, min(h, img_sy-y))
+            region = (x, y, w, h)
+        st = self.get_stats(region)
+        x, y, w, h = st.region
+        lines = [
+                "region %d,%d %dx%d (%.1f MP)" % (x, y, w, h, st.count / 1e6),
+                "      min  max    mean  stddev   clip0  clip255",
+                ]
+        names = ('R', 'G', 'B', 'A')
+        for c, spark in enumerate(st.sparklines()):
+            lines.append("%s    %4d %4d %7.2f %7.2f %7d %8d  %s" % (
+                names[c], st.min[c], st.max[c], st.mean[c], st.std[c],
+                st.clip_low[c], st.clip_high[c], spark))
+        return u'\n'.join(lines)
 
     def set_bg_color(self, color):
         """Set background color
@@ -539,6 +3532,13 @@ class PiewApp:
         If pos is None, image is centered.
         """
 
+        if self.strip is not None:
+            # only vertical relative moves, in display pixels
+            if pos is not None and rel:
+                self.strip.scroll(int(pos[1] * self.zoom), self.w.get_size()[1])
+            self.refresh()
+            return
+
         w_sx, w_sy = self.w.get_size()
         img_sx, img_sy = self.pb.get_width(), self.pb.get_height()
         if pos is None:
@@ -619,6 +3619,12 @@ class PiewApp:
         step scale is 1 for one screen height.
         """
 
+        if self.strip is not None:
+            w_sy = self.w.get_size()[1]
+            self.strip.scroll(int(step * w_sy), w_sy)
+            self.refresh()
+            return
+
         dy = step * float(self.w.get_size()[1]) / self.zoom
         if dy >= 0 and self.pos_y + dy/2 + 2 > self.pb.get_height():
             self.change_file(+1, adjust=False)
@@ -643,8 +3649,13 @@ class PiewApp:
             self.w.unfullscreen()
 
     def is_adjusted(self):
-        """Return True if the whole image fits in the window."""
+        """Return True if the whole image fits in the window.
 
+        Always True in strip mode, images are scrolled vertically.
+        """
+
+        if self.strip is not None:
+            return True
         w_sx, w_sy = self.w.get_size()
         return (
                 w_sx >= int(self.pb.get_width()*self.zoom) and
@@ -682,9 +3693,38 @@ class PiewApp:
     def ani_next_frame(self):
         if self.ani is None or not self.ani.is_animated():
             return  # silently ignore static images
+        prev = self._ani_display
         self.ani.advance()
         self.pb = self.ani.pixbuf()
-        self.redraw()
+        self.memory.set('image', self.pb)
+
+        # only redraw the region which changed since the previous frame
+        key = self.get_display_key()
+        if numpy is None or key is None:
+            self.redraw()
+            return
+        if prev is None or prev[0] != key:
+            # display changed: pixels (a copy of the frame) are retrieved
+            # only once it is stable
+            self.redraw()
+            self._ani_display = (key, None)
+            return
+        pixels = pixbuf_array(self.pb)
+        if prev[1] is None or prev[1].shape != pixels.shape:
+            self.redraw()
+        else:
+            dirty = pixbuf_diff_rect(prev[1], pixels)
+            if dirty is None:
+                pass  # nothing to redraw
+            elif self._back_damage is None:
+                # buffer to draw to holds the previous frame
+                self.redraw()
+                self._back_damage = dirty
+            elif self.redraw_damage(union_rect(self._back_damage, dirty)):
+                self._back_damage = dirty
+            else:
+                self._back_damage = union_rect(self._back_damage, dirty)
+        self._ani_display = (key, pixels)
 
     def get_pixel_color(self, x, y):
         """Get color of a given pixel.
@@ -706,22 +3746,48 @@ class PiewApp:
         """
 
         img_sx, img_sy = self.pb.get_width(), self.pb.get_height()
-        w_sx, w_sy = self.w.get_size()
-        x = int(round(float(self._mouse_x - w_sx/2) / self.zoom + self.pos_x))
-        y = int(round(float(self._mouse_y - w_sy/2) / self.zoom + self.pos_y))
+        x, y = self.window_to_image(self._mouse_x, self._mouse_y)
         if 0 <= x < img_sx and 0 <= y < img_sy:
             return (x, y)
         return None
 
+    def window_to_image(self, x, y):
+        """Convert window coordinates to image pixel coordinates."""
+
+        w_sx, w_sy = self.w.get_size()
+        x = int(round(float(x - w_sx/2) / self.zoom + self.pos_x))
+        y = int(round(float(y - w_sy/2) / self.zoom + self.pos_y))
+        return (x, y)
+
+    def set_selection(self, region):
+        """Set the selected image region (x,y,width,height), None to clear it."""
+
+        if region != self.selection:
+            self.selection = region
+            self.layout.queue_draw()
+
     def rotate(self, angle):
         """Rotate the image of the given angle (in degrees)
 
         Only multiple of 90 are supported.
+        Images cannot be rotated in strip mode.
         """
 
+        if self.strip is not None:
+            print "Cannot rotate images in strip mode"
+            return
         if angle % 90 != 0:
             raise ValueError("rotation angle not supported: %r" % angle)
+        if angle % 360 == 0:
+            return
+        size = self.memory.pixbuf_size(self.pb)
+        available = self.memory.reclaim(size, ('rotated',))
+        if available is not None and available < size:
+            print "Cannot rotate image: not enough memory"
+            return
         self.pb = self.pb.rotate_simple(angle % 360)
+        if self.ani is not None and self.pb is not self.ani.pixbuf():
+            self.memory.set('rotated', self.pb)
         self.move()
 
 
@@ -744,6 +3810,22 @@ class PiewApp:
             self.refresh()
         return True
 
+    def event_draw_selection(self, w, cr):
+        # drawn over the image, after layout children
+        if self.selection is None:
+            return False
+        x, y, sx, sy = self.selection
+        w_sx, w_sy = self.w.get_size()
+        x0 = round((x - 0.5 - self.pos_x) * self.zoom + w_sx/2)
+        y0 = round((y - 0.5 - self.pos_y) * self.zoom + w_sy/2)
+        x1 = round((x + sx - 0.5 - self.pos_x) * self.zoom + w_sx/2)
+        y1 = round((y + sy - 0.5 - self.pos_y) * self.zoom + w_sy/2)
+        Gdk.cairo_set_source_color(cr, self.selection_color)
+        cr.set_line_width(1)
+        cr.rectangle(x0 + 0.5, y0 + 0.5, max(0, x1 - x0 - 1), max(0, y1 - y0 - 1))
+        cr.stroke()
+        return False
+
     def event_window_state(self, w, ev):
         self._fullscreen = (ev.new_window_state & Gdk.WindowState.FULLSCREEN) != 0
         return True
@@ -758,8 +3840,14 @@ class PiewApp:
         if self.cmd.is_focus():
             if keyname == 'Escape':
                 self.cmd.hide()
+                self.find_info.hide()
             return False
 
+        if self._trash_confirm and keyname != 'Delete':
+            # any other key cancels trashing of marked files
+            self._trash_confirm = False
+            self.redraw_info()
+
         if keyname in ('q', 'Escape'):
             self.quit()
         elif keyname == 'f':
@@ -806,6 +3894,23 @@ class PiewApp:
         elif keyname == 'F5':
             self.set_filelist()
             self.load_image(self.cur_file)
+        # near duplicates
+        elif keyname == 'd':
+            self.dups_goto(+1)
+        elif keyname == 'D':
+            self.dups_goto(-1)
+        # continuous strip mode
+        elif keyname == 'c':
+            self.set_strip_mode()
+        # slideshow
+        elif keyname == 'S':
+            self.slideshow()
+        # image statistics
+        elif keyname == 's':
+            if numpy is None:
+                print "Image statistics require numpy"
+            else:
+                self.redraw_stats_info(not self.stats_info.get_visible())
         # animation
         elif keyname == 'p':
             self.ani_set_state()
@@ -816,35 +3921,21 @@ class PiewApp:
             self.cmd_show()
         elif keyname == 'g':
             self.cmd_show('goto ')
-
-        # delete file (ask for confirmation)
-        elif keyname == 'Delete' and self.cur_file:
-            dlg = Gtk.MessageDialog(self.w, Gtk.DialogFlags.MODAL,
-                    Gtk.MessageType.QUESTION, Gtk.ButtonsType.OK_CANCEL
-                    )
-            dlg.set_title("Piew, delete file")
-            dlg.set_markup("Deleting '%s'.\nAre your sure?" % GLib.markup_escape_text(self.cur_file))
-            ret = dlg.run()
-            dlg.destroy()
-            if ret == Gtk.ResponseType.OK:
-                # remove file
-                del_f = self.cur_file
-                try:
-                    os.remove(del_f)
-                except OSError as e:
-                    print "Cannot delete '%s': %s" % (self.cur_file, e)
-                    return True
-                # update filelist and current image
-                if len(self.files) == 1:
-                    # this image was the last one
-                    self.files = []
-                    self.load_image(None)
-                else:
-                    self.change_file(+1)
-                    try:  # just in case, it's safer
-                        self.files.remove(del_f)
-                    except Exception:
-                        pass
+        elif keyname == 'slash':
+            self.cmd_show('find ')
+        # file marks and operations (moved to trash, can be undone)
+        elif keyname == 'm':
+            self.mark()
+        elif keyname == 'u':
+            self.undo_file_operation()
+        elif keyname == 'Delete':
+            # trashing marked files must be confirmed
+            if self.marks and not self._trash_confirm:
+                self._trash_confirm = True
+                self.redraw_info()
+            else:
+                self._trash_confirm = False
+                self.file_operation('trash')
 
         else:  # not processed
             return False
@@ -876,6 +3967,20 @@ class PiewApp:
             self.redraw_pix_info()
         if not ev.state & Gdk.ModifierType.BUTTON1_MASK:
             return
+        if ev.state & Gdk.ModifierType.CONTROL_MASK and self.strip is None:
+            # select a region
+            x, y = self.window_to_image(ev.x, ev.y)
+            if self._select_start is None:
+                if self._press_x is not None:
+                    self._select_start = self.window_to_image(self._press_x, self._press_y)
+                else:
+                    self._select_start = self.window_to_image(ev.x, ev.y)
+            x0, y0 = self._select_start
+            self.set_selection((min(x, x0), min(y, y0), abs(x-x0)+1, abs(y-y0)+1))
+            self._drag_x, self._drag_y = ev.x, ev.y
+            if self.stats_info.get_visible():
+                self.redraw_stats_info()
+            return True
         if self._drag_x is None:
             self._drag_x, self._drag_y = ev.x, ev.y
         self.move((
@@ -888,6 +3993,8 @@ class PiewApp:
     def event_button_press(self, w, ev):
         if ev.button == 1:
             self._drag_x, self._drag_y = None, None
+            self._press_x, self._press_y = ev.x, ev.y
+            self._select_start = None
             return True
 
     def event_button_release(self, w, ev):
@@ -934,20 +4041,155 @@ class PiewApp:
             try:
                 {
                         # cmd_name: cmd_function
+                        'benchscale': self.cmd_benchscale,
+                        'copy': self.cmd_copy,
+                        'delete': self.cmd_delete,
+                        'dups': self.cmd_dups,
                         'eval': self.cmd_eval,
+                        'find': self.cmd_find,
                         'goto': self.cmd_goto,
+                        'mark': self.cmd_mark,
+                        'move': self.cmd_move,
                         'pixel': self.cmd_pixel,
                         'rotate': self.cmd_rotate,
                         'setbg': self.cmd_setbg,
+                        'slideshow': self.cmd_slideshow,
+                        'stats': self.cmd_stats,
+                        'strip': self.cmd_strip,
+                        'undo': self.cmd_undo,
                 }[args[0]](args[1])
             except Exception as e:
                 print "command error: %s" % e
         w.hide()
+        self.find_info.hide()
         return False
 
+    def event_cmd_changed(self, w):
+        """Display results of the search being typed."""
+        args = self.cmd.get_text().split(None, 1)
+        if len(args) < 2 or args[0] != 'find':
+            self.find_info.hide()
+            return
+        results = self.find_files(args[1], self.find_info_max_results)
+        if not results:
+            self.find_info.hide()
+            return
+        lines = [GLib.markup_escape_text(f) for f in results]
+        lines[0] = self.find_info_first_format % lines[0]
+        self.set_label_markup(self.find_info, self.find_info_format % '\n'.join(lines))
+        self.find_info.show()
+        self._last_w_s = 0, 0  # force resize, to reposition the label
+
+    def cmd_benchscale(self, s):
+        """Measure image scaling time against the number of threads.
+
+        Optional argument is the number of repetitions.
+        """
+        reps = int(s) if s.strip() else 20
+        pb, dst_sx, dst_sy = self.get_display_region()
+        ncpus = multiprocessing.cpu_count()
+        print "Scaling %dx%d to %dx%d, %d cores" % (
+            pb.get_width(), pb.get_height(), dst_sx, dst_sy, ncpus)
+        t1 = None
+        for n in range(1, max(ncpus, self.scale_threads or 0) + 1):
+            t0 = time.time()
+            for i in range(reps):
+                self.scale_pixbuf(pb, dst_sx, dst_sy, n)
+            t = (time.time() - t0) / reps
+            if t1 is None:
+                t1 = t
+            print "  %2d threads: %7.2f ms  x%.2f" % (n, t * 1000, t1 / t)
+        self.redraw()
+
+    def cmd_delete(self, s):
+        """Move marked files (or the current file) to trash."""
+        self.file_operation('trash')
+
+    def cmd_move(self, s):
+        """Move marked files (or the current file) to a directory."""
+        self.file_operation('move', s.strip())
+
+    def cmd_copy(self, s):
+        """Copy marked files (or the current file) to a directory."""
+        self.file_operation('copy', s.strip())
+
+    def cmd_undo(self, s):
+        """Undo the last file operation."""
+        self.undo_file_operation()
+
+    def cmd_mark(self, s):
+        """Change file marks.
+
+        Arguments:
+          (none) -- toggle mark of the current file
+          all -- mark all files
+          none -- clear all marks
+          invert -- invert marks of all files
+          find PATTERN -- mark files matching a search pattern
+        """
+        args = s.split(None, 1)
+        if not args:
+            self.mark()
+        elif args[0] == 'all':
+            self.mark(self.files, True)
+        elif args[0] == 'none':
+            self.mark(list(self.marks), False)
+        elif args[0] == 'invert':
+            self.mark(self.files)
+        elif args[0] == 'find' and len(args) == 2:
+            self.mark(self.find_files(args[1]), True)
+        else:
+            raise ValueError("invalid argument: %s" % s)
+
+    def cmd_dups(self, s):
+        """Handle near duplicates.
+
+        Arguments:
+          index -- compute perceptual hashes of files, in background
+          next, prev -- go to the next/previous group of near duplicates
+          filter -- keep one file per group of near duplicates
+          all -- restore the whole file list
+        """
+        s = s.strip() or 'next'
+        if s == 'index':
+            self.dups_index()
+        elif s == 'next':
+            self.dups_goto(+1)
+        elif s == 'prev':
+            self.dups_goto(-1)
+        elif s == 'filter':
+            self.dups_filter()
+        elif s == 'all':
+            self.set_filelist()
+            self.load_image(self.cur_file)
+        else:
+            raise ValueError("invalid argument: %s" % s)
+
     def cmd_eval(self, s):
         eval(s, globals(), {'self': self})
 
+    def cmd_find(self, s):
+        """Go to the next image matching a search pattern.
+
+        See FilenameIndex.search() for pattern syntax.
+        """
+        results = self.find_files(s)
+        if not results:
+            print "No file matching '%s'" % s
+            return
+        f = results[0]
+        if s.startswith('~') or len(results) == 1:
+            pass  # best match
+        else:
+            # results are sorted, get the first one after the current file
+            for ff in sorted(results):
+                if ff > self.cur_file:
+                    f = ff
+                    break
+            else:
+                f = min(results)
+        self.change_file(self.files.index(f), False)
+
     def cmd_goto(self, s):
         """Go to a given image, by index."""
         if s[0] in "+-":
@@ -964,10 +4206,293 @@ class PiewApp:
     def cmd_setbg(self, s):
         self.set_bg_color(s.strip())
 
+    def cmd_slideshow(self, s):
+        """Start slideshow with the given interval (in seconds), or stop it."""
+        s = s.strip()
+        if s == 'off':
+            self.slideshow(False)
+        elif s:
+            self.slideshow(True, float(s))
+        else:
+            self.slideshow()
+
+    def cmd_strip(self, s):
+        """Toggle continuous strip mode, or set it ('on' or 'off')."""
+        self.set_strip_mode({'on': True, 'off': False}.get(s.strip()))
+
+    def cmd_stats(self, s):
+        """Display image statistics.
+
+        Argument may be a region to select (x y width height), 'all' to clear
+        selection or 'off' to hide statistics.
+        """
+        s = s.strip()
+        if s == 'off':
+            return self.redraw_stats_info(False)
+        if self.strip is not None:
+            raise ValueError("statistics are not available in strip mode")
+        elif s == 'all':
+            self.set_selection(None)
+        elif s:
+            x, y, w, h = map(int, s.split())
+            self.set_selection((x, y, w, h))
+        self.redraw_stats_info()
+        print self.format_stats().encode('utf-8')
+
+
+# Worker processes
+# Worker functions are module-level to be usable by multiprocessing.
+
+_worker_archives = {}  # archives opened by a worker process: {path:archive}
+
+def _worker_image_data(fname, member):
+    """Return data of an image to decode in a worker process.
+
+    member is an (archive_class, archive_path, name) tuple for archive
+    members, None otherwise.
+    Return a (chunks, mapped_file) pair, mapped_file must be closed after
+    decoding if not None.
+    """
+    if member is None:
+        mf = MappedFile(fname)
+        return mf.chunks(), mf
+    cls, path, name = member
+    if path not in _worker_archives:
+        _worker_archives[path] = cls(path)
+    return _worker_archives[path].read(name), None
+
+def _worker_member(archive_members, fname):
+    """Return the member value to pass to _worker_image_data()."""
+    member = archive_members.get(fname)
+    if member is None:
+        return None
+    archive, name = member
+    return (archive.__class__, archive.path, name)
+
+
+def _phash_file(task):
+    """Compute perceptual hashes of an image, in a worker process.
+
+    task is a (fname, member) pair (see _worker_image_data()).
+    Return a (fname, dhash, phash, error) tuple.
+    """
+    fname, member = task
+    try:
+        data, mf = _worker_image_data(fname, member)
+        try:
+            pb = load_pixbuf_animation(data, (256, 256)).get_static_image()
+        finally:
+            if mf is not None:
+                mf.close()
+        if pb is None:
+            raise ValueError("cannot decode image")
+        dhash, phash = perceptual_hashes(pb)
+        return fname, dhash, phash, None
+    except Exception as e:
+        return fname, None, None, str(e) or e.__class__.__name__
+
+
+def phash_worker_main(argv):
+    """Perceptual hashes worker entry point.
+
+    Read a pickled list of _phash_file() tasks on stdin, write pickled
+    results on stdout, in completion order.
+    Pool processes are stopped when the worker is terminated.
+    """
+
+    import argparse
+    import signal
+    parser = argparse.ArgumentParser(prog="piew phash-worker")
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args(argv)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    tasks = pickle.load(sys.stdin)
+    pool = multiprocessing.Pool(args.jobs)
+    try:
+        results = pool.imap_unordered(_phash_file, tasks, 16)
+        while True:
+            try:
+                ret = results.next(1)  # with a timeout, to handle signals
+            except multiprocessing.TimeoutError:
+                continue
+            except StopIteration:
+                break
+            pickle.dump(ret, sys.stdout, pickle.HIGHEST_PROTOCOL)
+            sys.stdout.flush()
+    except (IOError, SystemExit):  # parent exited, or terminated
+        pool.terminate()
+        return 1
+    pool.close()
+    pool.join()
+    return 0
+
+
+# Batch export
+# Images are processed by a pool of worker processes.
+
+def _export_worker_init(mem_limit):
+    """Initialize an export worker process."""
+    if mem_limit:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (mem_limit, mem_limit))
+
+def _export_file(task):
+    """Export a single image, in a worker process.
+
+    task is a (fname, member, dst, size, fmt, options, rotate) tuple, member
+    being an (archive_class, archive_path, name) tuple for archive members.
+    Return a (fname, read bytes, written bytes, error) tuple.
+    """
+
+    fname, member, dst, size, fmt, options, rotate = task
+    nread = [0]
+    def count_chunks(chunks):
+        for chunk in chunks:
+            nread[0] += len(chunk)
+            yield chunk
+    try:
+        data, mf = _worker_image_data(fname, member)
+        try:
+            # image may be rotated: decode it to fit both orientations
+            max_size = None if size is None else (max(size),)*2
+            pb = load_pixbuf_animation(count_chunks(data), max_size).get_static_image()
+        finally:
+            if mf is not None:
+                mf.close()
+        if pb is None:
+            raise ValueError("cannot decode image")
+        if rotate:
+            opt = pb.get_option('orientation')
+            angle = exif_orientation_angles.get(opt and int(opt))
+            if angle:
+                pb = pb.rotate_simple(angle % 360)
+        if size is not None:
+            w, h = pb.get_width(), pb.get_height()
+            k = min(1., float(size[0])/w, float(size[1])/h)
+            if k < 1:
+                pb = pb.scale_simple(max(1, int(w*k)), max(1, int(h*k)), PiewApp.interp_type)
+        if fmt == 'jpeg' and pb.get_has_alpha():
+            pb = pb.composite_color_simple(pb.get_width(), pb.get_height(),
+                    GdkPixbuf.InterpType.NEAREST, 255, 1, 0xffffff, 0xffffff)
+        try:
+            os.makedirs(os.path.dirname(dst))
+        except OSError:
+            pass  # already exists, or error reported when saving
+        pb.savev(dst, fmt, options.keys(), options.values())
+        return fname, nread[0], os.path.getsize(dst), None
+    except Exception as e:
+        return fname, 0, 0, str(e) or e.__class__.__name__
+
+def export_output_path(fname, outdir, ext):
+    """Return output path of an exported file.
+
+    The input path is reproduced under outdir, without parent references.
+    The input extension is kept, so that images differing only by their
+    format are not exported to the same file.
+    Different paths may still be mapped to the same output (e.g. 'a/b.png'
+    and '../a/b.png'), callers must check it.
+    """
+    parts = [p for p in fname.split(os.sep) if p not in ('', '.', '..')]
+    return os.path.join(outdir, os.path.join(*parts) + '.' + ext)
+
+def export_main(argv):
+    """Batch export command line entry point."""
+
+    import argparse
+    parser = argparse.ArgumentParser(prog="piew export",
+            description="Export resized and rotated copies of images, without display.")
+    parser.add_argument('-o', '--output', metavar='DIR', required=True,
+                        help="output directory")
+    parser.add_argument('-s', '--size', metavar='WxH',
+                        help="fit images in the given size (never enlarged)")
+    parser.add_argument('-f', '--format', default='jpeg',
+                        help="output format (default: %(default)s)")
+    parser.add_argument('-q', '--quality', type=int,
+                        help="JPEG quality (0-100)")
+    parser.add_argument('--no-rotate', action='store_true',
+                        help="ignore EXIF orientation")
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help="number of worker processes (default: %(default)s)")
+    parser.add_argument('--memory-limit', metavar='MB', type=int,
+                        help="memory limit of each worker process")
+    parser.add_argument('--tasks-per-worker', metavar='N', type=int, default=200,
+                        help="restart workers after N images (default: %(default)s)")
+    parser.add_argument('files', nargs='+',
+                        help="files or directories to export")
+    args = parser.parse_args(argv)
+
+    size = None
+    if args.size:
+        try:
+            size = tuple(int(v) for v in args.size.lower().split('x'))
+            assert len(size) == 2 and min(size) > 0
+        except (ValueError, AssertionError):
+            parser.error("invalid size: %s" % args.size)
+    fmt = args.format.lower()
+    if fmt == 'jpg':
+        fmt = 'jpeg'
+    writable = dict((f.get_name(), f) for f in GdkPixbuf.Pixbuf.get_formats() if f.is_writable())
+    if fmt not in writable:
+        parser.error("unsupported output format: %s (supported: %s)" % (fmt, ', '.join(sorted(writable))))
+    ext = writable[fmt].get_extensions()[0]
+    options = {}
+    if args.quality is not None:
+        if fmt != 'jpeg':
+            parser.error("quality is only supported for JPEG")
+        options['quality'] = str(args.quality)
+    mem_limit = args.memory_limit and args.memory_limit << 20
+
+    files, archive_members = find_image_files(args.files, PiewApp.file_exts)
+    tasks = []
+    outputs = {}  # {dst:fname}
+    nerrors = 0
+    for f in files:
+        dst = export_output_path(f, args.output, ext)
+        if dst in outputs:
+            nerrors += 1
+            sys.stderr.write("Cannot export '%s': same output file as '%s'\n" % (f, outputs[dst]))
+            continue
+        outputs[dst] = f
+        tasks.append((f, _worker_member(archive_members, f), dst, size, fmt, options, not args.no_rotate))
+    del archive_members  # don't keep archives opened in the main process
+
+    pool = multiprocessing.Pool(args.jobs, _export_worker_init, (mem_limit,),
+                                args.tasks_per_worker)
+    ndone, nread, nwritten = 0, 0, 0
+    t0 = t_report = time.time()
+    def report(end='\r'):
+        dt = max(time.time() - t0, 1e-3)
+        sys.stderr.write("%d/%d images, %d errors, %.1f images/s, %.1f MB/s read, %.1f MB/s written%s" % (
+            ndone, len(tasks), nerrors, ndone/dt, nread/dt/1e6, nwritten/dt/1e6, end))
+        sys.stderr.flush()
+    try:
+        for fname, r, w, error in pool.imap_unordered(_export_file, tasks, 4):
+            ndone += 1
+            nread += r
+            nwritten += w
+            if error is not None:
+                nerrors += 1
+                sys.stderr.write("\nCannot export '%s': %s\n" % (fname, error))
+            if time.time() - t_report >= 1:
+                t_report = time.time()
+                report()
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        report('\n')
+        return 1
+    pool.join()
+    report('\n')
+    return 1 if nerrors else 0
+
 
 def main():
     import argparse
-    parser = argparse.ArgumentParser(usage="%(prog)s [-d FILE | FILES]")
+    if sys.argv[1:2] == ['export']:
+        sys.exit(export_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['phash-worker']:
+        sys.exit(phash_worker_main(sys.argv[2:]))
+    parser = argparse.ArgumentParser(usage="%(prog)s [-d FILE | FILES]\n       %(prog)s export -h")
     parser.add_argument('-d', '--directory', metavar='FILE',
                         help="browse directory of provided file")
     parser.add_argument('files', nargs='*',